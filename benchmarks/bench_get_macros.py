@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Time the streaming directive scanner in get_macros.py against the old
+whole file regex passes on a large synthetic header. Each run happens in a
+forked child so that peak RSS can be reported for it on its own
+"""
+import os
+import re
+import argparse
+import tempfile
+
+from common import run_forked
+from corpora import write_header
+from get_macros import iter_file_directives, split_macro
+
+
+def regex_macros(path):
+    # the whole file regex passes that get_macros.py used to do
+    rexp = re.compile(r'(?m)^#\s*define\s+((?:.*\\\r?\n)*.*)$')
+    multiline_comment_regex = re.compile(r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/")
+    with open(path, 'r') as f:
+        content = f.read()
+    matches = [i.groups()[0] for i in re.finditer(rexp, content)]
+    matches = [re.sub(r'\\*\s+', ' ', i) for i in matches]
+    matches = [re.sub(multiline_comment_regex, '', i) for i in matches]
+    return len(dict(i.split(' ', 1) for i in matches if ' ' in i))
+
+
+def streaming_macros(path):
+    macro_map = {}
+    for directive in iter_file_directives([path]):
+        if directive.kind == "define":
+            name, value, _ = split_macro(directive.text)
+            macro_map[name] = value
+    return len(macro_map)
+
+
+def streaming_count(path):
+    # what the single line/multiline/include output modes do
+    return sum(1 for _ in iter_file_directives([path]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--count", type=int, default=1000000,
+                        help="number of defines in the synthetic header")
+    parser.add_argument("--header", help="use this header instead of "
+                                         "generating one")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.header
+        if path is None:
+            path = os.path.join(tmpdir, "bench_regs.h")
+            write_header(path, args.count)
+        size = os.path.getsize(path)
+        print("header: %s (%.1f MB)" % (path, size / 1e6))
+        for name, func in [("regex map", regex_macros),
+                           ("streaming map", streaming_macros),
+                           ("streaming scan", streaming_count)]:
+            result, elapsed, maxrss, _ = run_forked(func, path)
+            print("%-15s %8d items %7.2fs %7.1f MB/s peak rss %6.1f MB" %
+                  (name, result, elapsed, size / elapsed / 1e6,
+                   maxrss / 1024))
+
+
+if __name__ == "__main__":
+    main()
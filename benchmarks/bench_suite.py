@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Run the core function of each script against synthetic inputs and record
+throughput and peak RSS as a json report, so that runs from before and
+after a change can be compared. Every benchmark runs in-process in its own
+forked child
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import itertools
+import argparse
+import tempfile
+
+import common
+import corpora
+
+# input sizes per scale
+SCALES = {
+    "small": {"payload": 16 << 20, "defines": 10000, "decls": 20000,
+              "dpkg": 10000, "hosts": 4, "maps": 1000, "addrs": 100000},
+    "medium": {"payload": 256 << 20, "defines": 100000, "decls": 200000,
+               "dpkg": 100000, "hosts": 8, "maps": 5000, "addrs": 1000000},
+    "large": {"payload": 4 << 30, "defines": 1000000, "decls": 1000000,
+              "dpkg": 100000, "hosts": 32, "maps": 20000, "addrs": 5000000},
+}
+# compressing is much slower than copying, so only this much of the payload
+# is compressed
+COMPRESS_LIMIT = 64 << 20
+BZIP2_LIMIT = 16 << 20
+
+
+class Corpus:
+    """
+    Generates the inputs for a scale into a directory on first use. The
+    names include the sizes and seed, so a kept --corpus-dir is reused
+    """
+    def __init__(self, directory, scale, seed=0):
+        self.directory = directory
+        self.sizes = SCALES[scale]
+        self.seed = seed
+
+    def _path(self, name):
+        return os.path.join(self.directory, "%s.s%d" % (name, self.seed))
+
+    def _generate(self, path, func, *args):
+        if not os.path.exists(path):
+            print("generating %s" % path, file=sys.stderr)
+            func(path, *args)
+        return path
+
+    def payload(self):
+        size = self.sizes["payload"]
+        return self._generate(self._path("payload-%d.bin" % size),
+                              corpora.write_payload, size, self.seed)
+
+    def header(self):
+        count = self.sizes["defines"]
+        return self._generate(self._path("regs-%d.h" % count),
+                              corpora.write_header, count, self.seed)
+
+    def preprocessed_tu(self):
+        count = self.sizes["decls"]
+        return self._generate(self._path("decls-%d.i" % count),
+                              corpora.write_preprocessed_tu, count, self.seed)
+
+    def dpkg_snapshots(self):
+        count, hosts = self.sizes["dpkg"], self.sizes["hosts"]
+        directory = self._path("dpkg-%d-%d" % (count, hosts))
+        if not os.path.isdir(directory):
+            print("generating %s" % directory, file=sys.stderr)
+            tmp = directory + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            corpora.write_dpkg_snapshots(tmp, count, hosts, self.seed)
+            os.rename(tmp, directory)
+        return sorted(os.path.join(directory, i) for i in os.listdir(directory))
+
+    def maps(self):
+        count, addrs = self.sizes["maps"], self.sizes["addrs"]
+        maps_path = self._path("maps-%d" % count)
+        addrs_path = self._path("addrs-%d-%d" % (count, addrs))
+        if not (os.path.exists(maps_path) and os.path.exists(addrs_path)):
+            print("generating %s" % maps_path, file=sys.stderr)
+            corpora.write_maps(maps_path, addrs_path, count, addrs, self.seed)
+        return maps_path, addrs_path
+
+
+# Each benchmark takes its input paths and returns (items, bytes processed)
+
+def bench_uimage_none(path):
+    import uimage_wrap
+    with open(path, "rb") as in_f, open(os.devnull, "wb") as out_f:
+        header = uimage_wrap.write_uimage(in_f, out_f, image_name="bench")
+    return 1, header.ih_size
+
+
+def bench_uimage_gzip(path):
+    import uimage_wrap
+    gzip = uimage_wrap.IHCompression.IH_COMP_GZIP
+    with open(path, "rb") as in_f, open(os.devnull, "wb") as out_f:
+        chunks = itertools.islice(
+            uimage_wrap.rebatch(uimage_wrap.iter_file_chunks(in_f), 1 << 20),
+            COMPRESS_LIMIT >> 20)
+        uimage_wrap.write_uimage_stream(
+            uimage_wrap.compress_chunks(chunks, gzip), out_f,
+            image_name="bench", compression=gzip)
+    return 1, min(os.path.getsize(path), COMPRESS_LIMIT)
+
+
+def bench_uimage_bzip2(path):
+    import uimage_wrap
+    bzip2 = uimage_wrap.IHCompression.IH_COMP_BZIP2
+    with open(path, "rb") as in_f, open(os.devnull, "wb") as out_f:
+        chunks = itertools.islice(
+            uimage_wrap.rebatch(uimage_wrap.iter_file_chunks(in_f), 1 << 20),
+            BZIP2_LIMIT >> 20)
+        uimage_wrap.write_uimage_stream(
+            uimage_wrap.compress_chunks(chunks, bzip2), out_f,
+            image_name="bench", compression=bzip2)
+    return 1, min(os.path.getsize(path), BZIP2_LIMIT)
+
+
+def bench_get_macros_scan(path):
+    from get_macros import iter_file_directives, split_macro
+    macro_map = {}
+    for directive in iter_file_directives([path]):
+        if directive.kind == "define":
+            name, value, _ = split_macro(directive.text)
+            macro_map[name] = value
+    return len(macro_map), os.path.getsize(path)
+
+
+def bench_get_macros_evaluate(path):
+    from get_macros import (iter_file_directives, split_macro,
+                            parse_function_macro, MacroEvaluator)
+    macro_map = {}
+    function_macros = {}
+    for directive in iter_file_directives([path]):
+        if directive.kind != "define":
+            continue
+        name, value, is_function_like = split_macro(directive.text)
+        if not is_function_like:
+            macro_map[name] = value
+            continue
+        parsed = parse_function_macro(directive.text)
+        if parsed is not None:
+            function_macros[parsed[0]] = (parsed[1], parsed[2])
+    values, _ = MacroEvaluator(macro_map, function_macros).evaluate_all()
+    return len(values), os.path.getsize(path)
+
+
+def bench_extract_functions(path):
+    from extract_function_signaure import extract_functions
+    with open(path, "r") as f:
+        count = sum(1 for _ in extract_functions(f))
+    return count, os.path.getsize(path)
+
+
+def bench_dpkg_matrix(paths):
+    from dpkg_install_diff import load_table
+    table = load_table(paths)
+    changed = sum(1 for _, _, kinds in table.changes()
+                  if any(k != "unchanged" for k in kinds))
+    return changed, sum(os.path.getsize(p) for p in paths)
+
+
+def bench_vmmap_resolve(maps_path, addrs_path):
+    bettervmmap = common.load_script("bettervmmap")
+    with open(maps_path, "r") as f:
+        index = bettervmmap.MapIndex(bettervmmap.parse_maps(f.read()))
+    with open(addrs_path, "r") as f:
+        mapped = sum(1 for res in bettervmmap.resolve_addrs(
+            index, bettervmmap.iter_addrs(f)) if res["mapped"])
+    return mapped, os.path.getsize(maps_path) + os.path.getsize(addrs_path)
+
+
+# name -> (corpus method, benchmark)
+BENCHMARKS = {
+    "uimage_wrap.none": ("payload", bench_uimage_none),
+    "uimage_wrap.gzip": ("payload", bench_uimage_gzip),
+    "uimage_wrap.bzip2": ("payload", bench_uimage_bzip2),
+    "get_macros.scan": ("header", bench_get_macros_scan),
+    "get_macros.evaluate": ("header", bench_get_macros_evaluate),
+    "extract_function_signaure.extract": ("preprocessed_tu",
+                                          bench_extract_functions),
+    "dpkg_install_diff.matrix": ("dpkg_snapshots", bench_dpkg_matrix),
+    "bettervmmap.resolve": ("maps", bench_vmmap_resolve),
+}
+
+
+# Checks that the output of a benchmark is still correct. They run once,
+# untimed, before the benchmark with the same inputs and raise CheckFailed on
+# a mismatch. Not assert, so that they still check under python -O
+
+class CheckFailed(Exception):
+    pass
+
+
+def check_uimage_bzip2(path):
+    # u-boot and the kernel only decompress the first bzip2 stream, so the
+    # whole payload has to come back out of a single one
+    import bz2
+    import uimage_wrap
+    with open(path, "rb") as f:
+        data = f.read(3 * uimage_wrap.BZ2_BLOCK_SIZE + 12345)
+    compressed = b"".join(uimage_wrap.compress_bzip2([data]))
+    decompressor = bz2.BZ2Decompressor()
+    out = decompressor.decompress(compressed)
+    if out != data:
+        raise CheckFailed("decompressed %d of %d bytes" % (len(out),
+                                                           len(data)))
+    if decompressor.unused_data:
+        raise CheckFailed("trailing data after the stream")
+
+
+def check_get_macros_evaluate(path):
+    from get_macros import MacroEvaluator
+    # C precedence and semantics, which differ from python's
+    cases = {
+        "4 | 1 == 1": 5,
+        "1 + !0": 2,
+        "!1 + 1": 1,
+        "~0 & 0xf": 0xf,
+        "6 & 3 == 3": 0,
+        "1 << 2 + 1": 8,
+        "1 < 2 == 1": 1,
+        "-7 / 2": -3,
+        "-7 % 2": -1,
+        "1 ? 2 : 3": 2,
+        "0 || 2 && 3": 1,
+        "(1U << 31) | 1": 0x80000001,
+        "0x10UL >> 1": 8,
+        "5 - 3 - 1": 1,
+    }
+    macro_map = {"CASE_%d" % i: body for i, body in enumerate(cases)}
+    values, errors = MacroEvaluator(macro_map, {}).evaluate_all()
+    for i, (body, expected) in enumerate(cases.items()):
+        got = values.get("CASE_%d" % i, errors.get("CASE_%d" % i))
+        if got != expected:
+            raise CheckFailed("%s evaluated to %r, not %r" % (body, got,
+                                                               expected))
+
+
+CHECKS = {
+    "uimage_wrap.bzip2": check_uimage_bzip2,
+    "get_macros.evaluate": check_get_macros_evaluate,
+}
+
+
+def run_benchmarks(names, corpus, repeat=1):
+    """
+    Run the named benchmarks, returning the results of the ones that ran and
+    the names of the ones whose check or run failed
+    """
+    results = []
+    failed = []
+    for name in names:
+        corpus_name, func = BENCHMARKS[name]
+        inputs = getattr(corpus, corpus_name)()
+        args = inputs if corpus_name == "maps" else (inputs,)
+        check = CHECKS.get(name)
+        if check is not None:
+            try:
+                check(*args)
+            except CheckFailed as err:
+                print("%-34s check failed: %s" % (name, err), file=sys.stderr)
+                failed.append(name)
+                continue
+        best = None
+        for _ in range(repeat):
+            try:
+                result, elapsed, maxrss, base_rss = common.run_forked(func,
+                                                                      *args)
+            except RuntimeError as err:
+                print("%-34s failed: %s" % (name, err), file=sys.stderr)
+                break
+            if best is None or elapsed < best[1]:
+                best = (result, elapsed, maxrss, base_rss)
+        if best is None:
+            failed.append(name)
+            continue
+        (items, nbytes), elapsed, maxrss, base_rss = best
+        entry = {"benchmark": name, "items": items, "bytes": nbytes,
+                 "seconds": round(elapsed, 4),
+                 "mb_per_s": round(nbytes / elapsed / 1e6, 2),
+                 "items_per_s": round(items / elapsed, 1),
+                 "peak_rss_kb": maxrss, "start_rss_kb": base_rss}
+        print("%-34s %9d items %8.3fs %9.1f MB/s peak rss %7.1f MB" %
+              (name, items, elapsed, entry["mb_per_s"], maxrss / 1024),
+              file=sys.stderr)
+        results.append(entry)
+    return results, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-s", "--scale", choices=sorted(SCALES),
+                        default="small")
+    parser.add_argument("-b", "--bench", action="append", default=[],
+                        choices=sorted(BENCHMARKS),
+                        help="benchmark to run, can be repeated. Defaults to "
+                             "all of them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="runs per benchmark, the fastest is reported")
+    parser.add_argument("--corpus-dir",
+                        help="keep the generated inputs here and reuse them, "
+                             "instead of a temporary directory")
+    parser.add_argument("-o", "--output",
+                        help="write the json report here instead of stdout")
+    parser.add_argument("-l", "--list", action="store_true", default=False,
+                        help="list the benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for name in BENCHMARKS:
+            print(name)
+        return
+
+    names = args.bench or list(BENCHMARKS)
+    tmpdir = None
+    corpus_dir = args.corpus_dir
+    if corpus_dir is None:
+        tmpdir = tempfile.mkdtemp(prefix="bench_suite")
+        corpus_dir = tmpdir
+    os.makedirs(corpus_dir, exist_ok=True)
+    try:
+        corpus = Corpus(corpus_dir, args.scale, args.seed)
+        results, failed = run_benchmarks(names, corpus, args.repeat)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "sizes": SCALES[args.scale],
+        "seed": args.seed,
+        "results": results,
+        "failed": failed,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if failed:
+        print("%d of %d benchmarks failed: %s" % (len(failed), len(names),
+                                                  ", ".join(failed)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
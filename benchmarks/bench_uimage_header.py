@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compare encoding and decoding uImage headers through the ctypes
+LegacyUImageHeader against the precompiled struct codec in uimage_wrap.py
+"""
+import timeit
+import zlib
+import argparse
+
+import common  # puts ../scripts on sys.path
+from uimage_wrap import (LegacyUImageHeader, UImageHeader, IH_MAGIC,
+                         encode_uimage_header, decode_uimage_header,
+                         uimage_header_crc)
+
+
+NAME = b"Linux-6.1.0-benchmark"
+
+
+def ctypes_encode():
+    header = LegacyUImageHeader()
+    header.ih_magic = IH_MAGIC
+    header.ih_time = 0
+    header.ih_size = 0x400000
+    header.ih_load = 0x80008000
+    header.ih_ep = 0x80008000
+    header.ih_dcrc = 0x12345678
+    header.ih_os = 5
+    header.ih_arch = 2
+    header.ih_type = 2
+    header.ih_comp = 0
+    for i, s in enumerate(NAME):
+        header.ih_name[i] = s
+    header.ih_hcrc = zlib.crc32(bytes(header))
+    return bytes(header)
+
+
+def struct_encode():
+    return encode_uimage_header(UImageHeader(IH_MAGIC, 0, 0, 0x400000,
+                                             0x80008000, 0x80008000,
+                                             0x12345678, 5, 2, 2, 0, NAME))
+
+
+def ctypes_decode(raw):
+    header = LegacyUImageHeader.from_buffer_copy(raw)
+    check = bytearray(raw)
+    check[4:8] = bytes(4)
+    return header, zlib.crc32(check) == header.ih_hcrc
+
+
+def struct_decode(raw):
+    header = decode_uimage_header(raw)
+    return header, uimage_header_crc(raw) == header.ih_hcrc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=100000,
+                        help="iterations per measurement")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw = struct_encode()
+    assert raw == ctypes_encode()
+    assert ctypes_decode(raw)[1] and struct_decode(raw)[1]
+
+    benches = [
+        ("encode ctypes", ctypes_encode),
+        ("encode struct", struct_encode),
+        ("decode ctypes", lambda: ctypes_decode(raw)),
+        ("decode struct", lambda: struct_decode(raw)),
+    ]
+    for name, func in benches:
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        print("%-14s %8.3f us/op" % (name, best / args.number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Helpers shared by the benchmarks: importing the scripts under ../scripts,
+including the ones without a .py extension, and running a function in a
+forked child so its time and peak RSS can be measured on their own
+"""
+import os
+import sys
+import json
+import time
+import resource
+from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_loader
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "scripts")
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+
+
+def load_script(name):
+    """
+    Import scripts/<name> as a module even if it has no .py extension, like
+    bettervmmap and syscall_lookup
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    loader = SourceFileLoader(name, os.path.join(SCRIPTS_DIR, name))
+    module = module_from_spec(spec_from_loader(name, loader))
+    loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+
+def run_forked(func, *args):
+    """
+    Run func(*args) in a forked child. Returns (result, seconds, peak rss
+    in KB, rss in KB at the start). The child starts out sharing the
+    parent's pages, so the starting rss is reported to compare against
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.perf_counter()
+            result = func(*args)
+            elapsed = time.perf_counter() - start
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            payload = [result, elapsed, maxrss, base_rss]
+        except BaseException as err:
+            payload = {"error": "%s: %s" % (type(err).__name__, err)}
+            status = 1
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(json.dumps(payload).encode())
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    result = json.loads(data) if data else {"error": "child died"}
+    if isinstance(result, dict):
+        raise RuntimeError(result["error"])
+    return tuple(result)
@@ -0,0 +1,185 @@
+"""
+Reproducible synthetic inputs for the benchmarks. Every generator is seeded,
+so the same arguments always write the same bytes and corpora can be kept
+around between runs and compared
+"""
+import os
+import random
+
+PAYLOAD_BLOCK = 1 << 20
+archs = ["amd64", "arm64", "armhf", "i386", "all"]
+map_objects = ["/usr/lib/x86_64-linux-gnu/libc.so.6",
+               "/usr/lib/x86_64-linux-gnu/libstdc++.so.6.0.30",
+               "/usr/lib/x86_64-linux-gnu/libssl.so.3",
+               "/usr/bin/service", "[heap]", "[stack]", "", "",
+               "/memfd:jit-cache (deleted)"]
+c_types = ["int", "unsigned long", "const char *", "void *", "size_t",
+           "struct bench_ctx *", "uint32_t", "double", "long long"]
+
+
+def write_payload(path, size, seed=0):
+    """
+    Write size bytes of incompressible data like a kernel or rootfs payload.
+    A random block is generated once and every copy is xored with its index
+    so that no two blocks are the same
+    """
+    rng = random.Random(seed)
+    block = bytearray(rng.randbytes(PAYLOAD_BLOCK))
+    with open(path, "wb") as f:
+        written = 0
+        index = 0
+        while written < size:
+            block[:8] = index.to_bytes(8, "little")
+            chunk = block[:min(PAYLOAD_BLOCK, size - written)]
+            f.write(chunk)
+            written += len(chunk)
+            index += 1
+
+
+def write_header(path, count, seed=0):
+    """
+    Write a header resembling generated SoC register definitions, with
+    comments, masks built from shift macros, a chain of base addresses that
+    each refer to the one before (about a tenth of the defines deep) and
+    the occasional multiline macro. Every object like macro resolves
+    """
+    rng = random.Random(seed)
+    last_base = None
+    with open(path, "w") as f:
+        f.write("#ifndef __BENCH_REGS_H\n#define __BENCH_REGS_H\n")
+        for i in range(count):
+            kind = rng.random()
+            if kind < 0.6:
+                f.write("#define REG_%d_OFFSET 0x%08x /* register %d */\n" %
+                        (i, rng.getrandbits(32), i))
+            elif kind < 0.8:
+                f.write("#define REG_%d_SHIFT %d\n/*\n * field %d\n */\n"
+                        "#define REG_%d_MASK (0x%xUL << REG_%d_SHIFT)\n" %
+                        (i, rng.randrange(24), i, i, rng.getrandbits(8), i))
+            elif kind < 0.9:
+                if last_base is None:
+                    f.write("#define REG_%d_BASE 0x%08xUL\n" %
+                            (i, rng.getrandbits(28) << 4))
+                else:
+                    f.write("#define REG_%d_BASE (REG_%d_BASE + 0x%x)\n" %
+                            (i, last_base, rng.randrange(1, 16) << 4))
+                last_base = i
+            else:
+                f.write("#define REG_%d_SET(x) \\\n\t(((x) & 0xff) \\\n"
+                        "\t << %d)\n" % (i, rng.randrange(32)))
+        f.write("#endif\n")
+
+
+def write_preprocessed_tu(path, count, seed=0):
+    """
+    Write preprocessor output with count top level declarations spread over
+    a few headers: prototypes, typedefs, structs and inline definitions
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        f.write('# 1 "bench.c"\n# 1 "<built-in>"\n# 1 "bench.c"\n')
+        line = 1
+        for i in range(count):
+            if i % 500 == 0:
+                line = 1
+                f.write('# %d "/usr/include/bench_%d.h" 1 3 4\n' %
+                        (line, i // 500))
+            kind = rng.random()
+            params = ", ".join("%s arg%d" % (rng.choice(c_types), j)
+                               for j in range(rng.randrange(5)))
+            if kind < 0.6:
+                f.write("extern %s bench_func_%d (%s) "
+                        "__attribute__ ((__nothrow__ , __leaf__));\n" %
+                        (rng.choice(c_types), i, params or "void"))
+                line += 1
+            elif kind < 0.75:
+                f.write("typedef struct bench_%d {\n  int a;\n  char *b;\n"
+                        "} bench_%d_t;\n" % (i, i))
+                line += 4
+            elif kind < 0.9:
+                f.write("static __inline__ %s\nbench_inline_%d (%s)\n{\n"
+                        "  return 0;\n}\n" % (rng.choice(c_types), i,
+                                              params or "void"))
+                line += 5
+            else:
+                f.write("extern void (*bench_handler_%d (int sig, void "
+                        "(*handler) (int))) (int);\n" % i)
+                line += 1
+
+
+def write_dpkg_snapshots(directory, count, snapshots, seed=0):
+    """
+    Write `dpkg -l` listings of count packages for snapshots hosts. Each
+    host removes, adds, upgrades and switches the arch of a few percent of
+    the packages of the first one. Returns the paths
+    """
+    rng = random.Random(seed)
+    base = []
+    for i in range(count):
+        base.append(("libbench%d-%d" % (i % 97, i),
+                     "%d:%d.%d.%d-%dubuntu%d" % (rng.randrange(3),
+                                                rng.randrange(10),
+                                                rng.randrange(30),
+                                                rng.randrange(100),
+                                                rng.randrange(5),
+                                                rng.randrange(3)),
+                     rng.choice(archs)))
+    paths = []
+    for host in range(snapshots):
+        path = os.path.join(directory, "host%03d.dpkg" % host)
+        with open(path, "w") as f:
+            f.write("Desired=Unknown/Install/Remove/Purge/Hold\n"
+                    "| Status=Not/Inst/Conf-files/Unpacked/halF-conf/"
+                    "Half-inst/trig-aWait/Trig-pend\n"
+                    "|/ Err?=(none)/Reinst-required (Status,Err: "
+                    "uppercase=bad)\n"
+                    "||/ Name Version Architecture Description\n"
+                    "+++-====-=======-============-===========\n")
+            for name, version, arch in base:
+                roll = rng.random() if host else 1.0
+                if roll < 0.02:
+                    continue
+                if roll < 0.05:
+                    version += "+host%d" % host
+                elif roll < 0.06:
+                    version += "~rc1"
+                elif roll < 0.065:
+                    arch = "i386" if arch != "i386" else "amd64"
+                f.write("ii  %s %s %s synthetic package %s\n" %
+                        (name, version, arch, name))
+            for i in range(int(count * 0.01) if host else 0):
+                f.write("ii  host%d-extra-%d 1.0-1 amd64 added package\n" %
+                        (host, i))
+        paths.append(path)
+    return paths
+
+
+def write_maps(maps_path, addrs_path, count, addr_count, seed=0):
+    """
+    Write a /proc/<pid>/maps file with count mappings and a file of
+    addr_count addresses, most of which fall in one of the mappings
+    """
+    rng = random.Random(seed)
+    ranges = []
+    addr = 0x555555554000
+    with open(maps_path, "w") as f:
+        for i in range(count):
+            if i == count // 2:
+                addr = 0x7f0000000000
+            size = rng.randrange(1, 64) * 0x1000
+            perms = rng.choice(["r--p", "r-xp", "rw-p", "---p", "rw-s"])
+            obj = rng.choice(map_objects)
+            inode = rng.randrange(1, 1 << 20) if obj.startswith("/") else 0
+            f.write("%012x-%012x %s %08x fe:01 %-10d %s\n" %
+                    (addr, addr + size, perms, rng.randrange(64) * 0x1000,
+                     inode, obj))
+            ranges.append((addr, addr + size))
+            addr += size + rng.randrange(0, 4) * 0x1000
+    with open(addrs_path, "w") as f:
+        for _ in range(addr_count):
+            start, end = rng.choice(ranges)
+            if rng.random() < 0.1:
+                # mostly unmapped, the gaps and the end of the last mapping
+                f.write("0x%x\n" % (end + rng.randrange(0x1000)))
+            else:
+                f.write("0x%x\n" % rng.randrange(start, end))
@@ -1,34 +1,320 @@
 import re
+import os
+import sys
+import json
 import argparse
+import itertools
+from functools import lru_cache
 
-parser = argparse.ArgumentParser()
-parser.add_argument("old_filepath", help="path to old dpkg -l output")
-parser.add_argument("new_filepath", help="path to new dpkg -l output")
-args = parser.parse_args()
+import script_stats
 
-dpkg_rexp = re.compile("^(?P<STATUS>\S+)\s+(?P<NAME>\S+)\s+(?P<VERSION>\S+)\s+(?P<ARCH>\S+)\s+(?P<DESC>.+)$")
+dpkg_rexp = re.compile(r"^(?P<STATUS>\S+)\s+(?P<NAME>\S+)\s+(?P<VERSION>\S+)\s+(?P<ARCH>\S+)\s+(?P<DESC>.+)$")
 
+# kinds of change from the baseline snapshot
+UNCHANGED = "unchanged"
+ADDED = "added"
+REMOVED = "removed"
+UPGRADED = "upgrade"
+DOWNGRADED = "downgrade"
+# versions that differ as strings but compare equal, like 1.0 and 0:1.0
+VERSION_CHANGED = "version"
+ARCH_CHANGED = "arch"
+change_markers = {UNCHANGED: " ", ADDED: "+", REMOVED: "-", UPGRADED: ">",
+                  DOWNGRADED: "<", VERSION_CHANGED: "~", ARCH_CHANGED: "!"}
 
-old_filepath = args.old_filepath
-new_filepath = args.new_filepath
+DPKG_STATUS_PATH = os.path.join("var", "lib", "dpkg", "status")
+# package states that dpkg doesn't consider to be installed
+absent_states = {"not-installed", "config-files"}
 
-with open(old_filepath, "r") as f:
-    old_package_lines = f.read().splitlines()
 
-with open(new_filepath, "r") as f:
-    new_package_lines = f.read().splitlines()
+def iter_dpkg_list(f):
+    """
+    Yield (name, version, arch) for every package line of `dpkg -l` output.
+    Strings are interned since the same versions and architectures show up
+    across many snapshots
+    """
+    intern = sys.intern
+    for line in f:
+        match = dpkg_rexp.match(line)
+        # skip the "||/ Name Version ..." column header too
+        if match is None or not match.group("STATUS").isalpha():
+            continue
+        yield (intern(match.group("NAME")), intern(match.group("VERSION")),
+               intern(match.group("ARCH")))
 
 
-old_matches = [re.match(dpkg_rexp, a) for a in old_package_lines]
-old_entries = [i.groupdict() for i in old_matches if i is not None]
+def iter_dpkg_status(f):
+    """
+    Yield (name, version, arch) for every installed package in a
+    /var/lib/dpkg/status formatted file, one stanza at a time. Multi-Arch:
+    same packages are named name:arch like dpkg -l does
+    """
+    intern = sys.intern
+    fields = {}
+    # an empty line at the end flushes the last stanza
+    for line in itertools.chain(f, [""]):
+        if line[:1] in (" ", "\t"):
+            # continuation of a multiline field like Description
+            continue
+        line = line.rstrip("\n")
+        if line:
+            key, sep, value = line.partition(":")
+            if sep:
+                fields[key.lower()] = value.strip()
+            continue
+        if not fields:
+            continue
+        name = fields.get("package")
+        status = fields.get("status", "").split()
+        if name and status and status[-1] not in absent_states:
+            arch = fields.get("architecture", "")
+            if fields.get("multi-arch") == "same":
+                name = "%s:%s" % (name, arch)
+            yield (intern(name), intern(fields.get("version", "")),
+                   intern(arch))
+        fields = {}
 
-new_matches = [re.match(dpkg_rexp, a) for a in new_package_lines]
-new_entries = [i.groupdict() for i in new_matches if i is not None]
 
-old_names = set([i['NAME'] for i in old_entries])
-new_names = set([i['NAME'] for i in new_entries])
+def open_snapshot(path):
+    if path == "-":
+        return open(sys.stdin.fileno(), "r", closefd=False)
+    if os.path.isdir(path):
+        # root of an extracted image or chroot
+        path = os.path.join(path, DPKG_STATUS_PATH)
+    return open(path, "r", errors="replace")
 
-diff = list(old_names.difference(new_names))
-diff.sort()
-for i in diff:
-    print(i)
+
+def iter_snapshot(f, fmt="auto"):
+    """
+    Yield (name, version, arch) from either dpkg -l output or a dpkg status
+    file. With fmt="auto" the first non-empty line decides, since status
+    files always start with a field
+    """
+    if fmt == "auto":
+        first = ""
+        for first in f:
+            if first.strip():
+                break
+        fmt = "status" if re.match(r"^[A-Za-z][\w-]*:", first) else "list"
+        f = itertools.chain([first], f)
+    if fmt == "status":
+        return iter_dpkg_status(f)
+    return iter_dpkg_list(f)
+
+
+def _version_order(c):
+    # ~ sorts before everything, even the end of the string, and letters
+    # sort before other characters
+    if c == "~":
+        return -1
+    if c.isdigit():
+        return 0
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_fragment(a, b):
+    """
+    Compare an upstream version or debian revision the way dpkg does,
+    alternating between non-digit and digit runs
+    """
+    i = j = 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or \
+                (j < len(b) and not b[j].isdigit()):
+            ac = _version_order(a[i]) if i < len(a) else 0
+            bc = _version_order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == "0":
+            i += 1
+        while j < len(b) and b[j] == "0":
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+@lru_cache(maxsize=None)
+def parse_version(version):
+    """
+    Split a debian version into (epoch, upstream, revision)
+    """
+    epoch, sep, rest = version.partition(":")
+    if not sep:
+        epoch, rest = "0", version
+    upstream, sep, revision = rest.rpartition("-")
+    if not sep:
+        upstream, revision = rest, ""
+    return int(epoch) if epoch.isdigit() else 0, upstream, revision
+
+
+@lru_cache(maxsize=None)
+def compare_versions(a, b):
+    """
+    Return <0, 0 or >0 as debian version a is older, the same or newer
+    than b. Cached since the same version pairs come up on every host
+    """
+    a_epoch, a_upstream, a_revision = parse_version(a)
+    b_epoch, b_upstream, b_revision = parse_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return (_compare_fragment(a_upstream, b_upstream) or
+            _compare_fragment(a_revision, b_revision))
+
+
+class SnapshotTable:
+    """
+    Table of packages by snapshot. Each package maps to a list with an
+    entry per snapshot that is either (version, arch) or None if the
+    package isn't installed there
+    """
+    def __init__(self):
+        self.labels = []
+        self.packages = {}
+
+    def add_snapshot(self, label, entries):
+        index = len(self.labels)
+        self.labels.append(label)
+        for row in self.packages.values():
+            row.append(None)
+        for name, version, arch in entries:
+            row = self.packages.get(name)
+            if row is None:
+                row = [None] * (index + 1)
+                self.packages[name] = row
+            row[index] = (version, arch)
+
+    def changes(self, baseline=0):
+        """
+        Yield (name, row, kinds) for every package, where kinds is the kind
+        of change of each snapshot relative to the baseline snapshot
+        """
+        for name in sorted(self.packages):
+            row = self.packages[name]
+            base = row[baseline]
+            kinds = []
+            for entry in row:
+                if entry == base:
+                    kinds.append(UNCHANGED)
+                elif base is None:
+                    kinds.append(ADDED)
+                elif entry is None:
+                    kinds.append(REMOVED)
+                elif entry[0] != base[0]:
+                    order = compare_versions(entry[0], base[0])
+                    if order > 0:
+                        kinds.append(UPGRADED)
+                    elif order < 0:
+                        kinds.append(DOWNGRADED)
+                    else:
+                        kinds.append(VERSION_CHANGED)
+                else:
+                    kinds.append(ARCH_CHANGED)
+            yield name, row, kinds
+
+
+def load_table(paths, fmt="auto"):
+    table = SnapshotTable()
+    for path in paths:
+        with open_snapshot(path) as f:
+            # add_snapshot consumes the lines as they are read
+            table.add_snapshot(path, iter_snapshot(f, fmt))
+    return table
+
+
+def print_matrix(table, show_all=False):
+    rows = []
+    for name, row, kinds in table.changes():
+        if not show_all and all(k == UNCHANGED for k in kinds):
+            continue
+        cells = [name]
+        for entry, kind in zip(row, kinds):
+            cell = "-" if entry is None else "%s:%s" % entry
+            cells.append(change_markers[kind] + cell)
+        rows.append(cells)
+
+    header = ["package"] + table.labels
+    widths = [max([len(header[i])] + [len(r[i]) for r in rows])
+              for i in range(len(header))]
+    for cells in [header] + rows:
+        print("  ".join(c.ljust(w) for c, w in zip(cells, widths)).rstrip())
+
+
+def matrix_json(table, show_all=False):
+    summary = [{k: 0 for k in change_markers} for _ in table.labels]
+    packages = {}
+    for name, row, kinds in table.changes():
+        for i, kind in enumerate(kinds):
+            if row[i] is not None or kind != UNCHANGED:
+                summary[i][kind] += 1
+        if not show_all and all(k == UNCHANGED for k in kinds):
+            continue
+        packages[name] = [
+            None if entry is None else
+            {"version": entry[0], "arch": entry[1], "change": kind}
+            for entry, kind in zip(row, kinds)]
+    return {"snapshots": table.labels, "baseline": table.labels[0],
+            "summary": dict(zip(table.labels, summary)),
+            "packages": packages}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="By default print the packages in the first snapshot "
+                    "that are missing from the second. With --matrix or "
+                    "--json, compare any number of snapshots against the "
+                    "first one")
+    parser.add_argument("snapshots", nargs="+",
+                        help="paths to dpkg -l output, dpkg status files or "
+                             "root filesystem directories containing "
+                             "%s, - for stdin" % DPKG_STATUS_PATH)
+    parser.add_argument("-f", "--format", choices=["auto", "list", "status"],
+                        default="auto",
+                        help="snapshot format, dpkg -l output or dpkg "
+                             "status file. auto detects it per snapshot")
+    parser.add_argument("-m", "--matrix", action="store_true", default=False,
+                        help="print a package x snapshot matrix of added (+), "
+                             "removed (-), upgraded (>), downgraded (<), "
+                             "version changed (~) and arch changed (!) "
+                             "packages")
+    parser.add_argument("-j", "--json", action="store_true", default=False,
+                        help="output the matrix as json")
+    parser.add_argument("-a", "--all", action="store_true", default=False,
+                        help="include packages that didn't change")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not (args.matrix or args.json) and len(args.snapshots) != 2:
+        parser.error("exactly two snapshots are needed without "
+                     "--matrix/--json")
+
+    with script_stats.from_args(args, "dpkg_install_diff"):
+        with script_stats.phase("load"):
+            table = load_table(args.snapshots, args.format)
+        with script_stats.phase("output"):
+            if args.json:
+                print(json.dumps(matrix_json(table, args.all), indent=2))
+            elif args.matrix:
+                print_matrix(table, args.all)
+            else:
+                for name, row, kinds in table.changes():
+                    if kinds[1] == REMOVED:
+                        print(name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Find the ELF files under a directory and print their class, endianness,
+machine, type and interpreter. A faster and stricter find_elf_files.sh
+"""
+import os
+import json
+import struct
+import fnmatch
+import argparse
+import itertools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import script_stats
+
+ELF_MAGIC = b"\x7fELF"
+PT_INTERP = 3
+# enough for the ELF header, the program headers and the interpreter path of
+# nearly every file, so classifying one takes a single read
+HEAD_SIZE = 4096
+
+elf_classes = {1: "32", 2: "64"}
+elf_endians = {1: "LE", 2: "BE"}
+elf_types = {0: "NONE", 1: "REL", 2: "EXEC", 3: "DYN", 4: "CORE"}
+elf_machines = {
+    2: "SPARC", 3: "x86", 4: "m68k", 8: "MIPS", 10: "MIPS_RS3_LE",
+    15: "PARISC", 18: "SPARC32PLUS", 20: "PowerPC", 21: "PowerPC64",
+    22: "S390", 40: "ARM", 42: "SuperH", 43: "SPARCV9", 50: "IA-64",
+    62: "x86-64", 83: "AVR", 92: "OpenRISC", 94: "Xtensa", 105: "MSP430",
+    164: "Hexagon", 183: "AArch64", 189: "MicroBlaze", 243: "RISC-V",
+    247: "BPF", 258: "LoongArch",
+}
+
+# (e_type, e_machine, e_phoff, e_phentsize, e_phnum) and
+# (p_type, p_offset, p_filesz) for each class, without the byte order prefix
+ElfLayout = namedtuple("ElfLayout", ["ehdr", "ehdr_fields", "phdr",
+                                     "phdr_fields"])
+elf_layouts = {
+    1: ElfLayout("HHIIIIIHHHHHH", (0, 1, 4, 8, 9), "IIIIIIII", (0, 1, 4)),
+    2: ElfLayout("HHIQQQIHHHHHH", (0, 1, 4, 8, 9), "IIQQQQQQ", (0, 2, 5)),
+}
+
+ElfInfo = namedtuple("ElfInfo", ["path", "elf_class", "endian", "machine",
+                                 "type", "interp"])
+
+
+def iter_files(paths):
+    """
+    Yield the path of every regular file under paths with os.scandir, in
+    the order paths are given. Symlinks in paths are followed, symlinks
+    found while walking the directories are skipped
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from _walk(path)
+        elif os.path.isfile(path):
+            yield path
+
+
+def _walk(root):
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            subdirs = []
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path
+                except OSError:
+                    continue
+            # reversed so that directories come out in listing order
+            stack.extend(reversed(subdirs))
+
+
+def classify_head(path, head, fd=None):
+    """
+    Return an ElfInfo for the file whose first bytes are head, or None if
+    it isn't an ELF file. fd is used to read the interpreter if it is past
+    the end of head
+    """
+    if len(head) < 20 or head[:4] != ELF_MAGIC:
+        return None
+    elf_class = head[4]
+    layout = elf_layouts.get(elf_class)
+    order = {1: "<", 2: ">"}.get(head[5])
+    if layout is None or order is None:
+        return None
+    ehdr = struct.Struct(order + layout.ehdr)
+    if len(head) < 16 + ehdr.size:
+        return None
+    fields = ehdr.unpack_from(head, 16)
+    e_type, e_machine, phoff, phentsize, phnum = \
+        (fields[i] for i in layout.ehdr_fields)
+
+    interp = None
+    phdr = struct.Struct(order + layout.phdr)
+    type_i, offset_i, filesz_i = layout.phdr_fields
+    if phoff and phentsize >= phdr.size:
+        for i in range(phnum):
+            start = phoff + i * phentsize
+            if start + phdr.size > len(head):
+                break
+            p = phdr.unpack_from(head, start)
+            if p[type_i] != PT_INTERP:
+                continue
+            offset, size = p[offset_i], min(p[filesz_i], 4096)
+            raw = head[offset:offset + size]
+            if len(raw) < size and fd is not None:
+                raw = os.pread(fd, size, offset)
+            interp = raw.split(b"\0", 1)[0].decode("utf-8", "replace")
+            break
+
+    return ElfInfo(path, elf_classes[elf_class], elf_endians[head[5]],
+                   elf_machines.get(e_machine, "EM_%d" % e_machine),
+                   elf_types.get(e_type, "0x%x" % e_type), interp)
+
+
+def classify(path):
+    try:
+        # symlinks are already skipped by the walk, so one here was given
+        # on the command line
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return classify_head(path, os.pread(fd, HEAD_SIZE, 0), fd)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def classify_batch(paths):
+    return [info for info in map(classify, paths) if info is not None]
+
+
+def iter_batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def classify_paths(paths, jobs=None, batch_size=256):
+    """
+    Yield an ElfInfo for every ELF file under paths. Files are read in
+    batches on a thread pool, since the time goes to open and read
+    """
+    with ThreadPoolExecutor(jobs) as pool:
+        for infos in pool.map(classify_batch,
+                              iter_batches(iter_files(paths), batch_size)):
+            yield from infos
+
+
+def make_filter(args):
+    machines = {m.lower() for m in args.machine}
+    types = {t.upper() for t in args.type}
+
+    def matches(info):
+        if args.elf_class and info.elf_class != args.elf_class:
+            return False
+        if args.endian and info.endian != args.endian.upper():
+            return False
+        if machines and info.machine.lower() not in machines:
+            return False
+        if types and info.type not in types:
+            return False
+        if args.static and info.interp is not None:
+            return False
+        if args.interp and (info.interp is None or
+                            not fnmatch.fnmatch(info.interp, args.interp)):
+            return False
+        return True
+    return matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("paths", nargs="*", default=["."],
+                        help="files and directories to search, defaults to .")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of threads to read files with")
+    parser.add_argument("--class", dest="elf_class", choices=["32", "64"])
+    parser.add_argument("--endian", choices=["le", "be", "LE", "BE"])
+    parser.add_argument("-m", "--machine", action="append", default=[],
+                        help="only show this machine, e.g. ARM or x86-64. "
+                             "Can be repeated")
+    parser.add_argument("-t", "--type", action="append", default=[],
+                        help="only show this type, one of EXEC, DYN, REL "
+                             "and CORE. Can be repeated")
+    parser.add_argument("--interp",
+                        help="only show files with an interpreter matching "
+                             "this glob")
+    parser.add_argument("--static", action="store_true", default=False,
+                        help="only show files without an interpreter")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true", default=False,
+                        help="print a json list instead of a table")
+    output.add_argument("-l", "--paths-only", action="store_true",
+                        default=False,
+                        help="only print the paths, like find_elf_files.sh")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    with script_stats.from_args(args, "elf_classify"):
+        run(args)
+
+
+def run(args):
+    matches = make_filter(args)
+    infos = script_stats.timed_iter(
+        "classify", classify_paths(args.paths, args.jobs), measure=None)
+    infos = (i for i in infos if matches(i))
+    if args.json:
+        print(json.dumps([i._asdict() for i in infos], indent=2))
+        return
+    for info in infos:
+        if args.paths_only:
+            print(info.path)
+            continue
+        print("%-2s %s %-11s %-4s %-32s %s" %
+              (info.elf_class, info.endian, info.machine, info.type,
+               info.interp or "-", info.path))
+
+
+if __name__ == "__main__":
+    main()
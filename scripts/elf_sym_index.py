@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Index the symbols defined by every ELF file under a directory so that the
+objects defining a symbol can be looked up without running readelf on
+every file each time, like find_elf_defining_sym.sh does
+"""
+import os
+import sys
+import mmap
+import struct
+import sqlite3
+import logging
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import script_stats
+
+log = logging.getLogger("elf_sym_index")
+log.addHandler(logging.StreamHandler())
+log.setLevel(logging.INFO)
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".cache",
+                             "elf_sym_index.sqlite")
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHT_SYMTAB_SHNDX = 18
+SHN_UNDEF = 0
+SHN_XINDEX = 0xffff
+STT_SECTION = 3
+STT_FILE = 4
+
+sym_types = {0: "NOTYPE", 1: "OBJECT", 2: "FUNC", 3: "SECTION", 4: "FILE",
+             5: "COMMON", 6: "TLS", 10: "IFUNC"}
+sym_binds = {0: "LOCAL", 1: "GLOBAL", 2: "WEAK", 10: "UNIQUE"}
+section_kinds = {SHT_SYMTAB: "symtab", SHT_DYNSYM: "dynsym"}
+
+# struct layouts for each class, without the byte order prefix. Symbols are
+# reordered to (name, info, shndx, value, size) after unpacking
+ElfLayout = namedtuple("ElfLayout", ["ehdr", "shdr", "sym", "sym_order"])
+elf_layouts = {
+    ELFCLASS32: ElfLayout(ehdr="HHIIIIIHHHHHH", shdr="IIIIIIIIII",
+                          sym="IIIBBH", sym_order=(0, 3, 5, 1, 2)),
+    ELFCLASS64: ElfLayout(ehdr="HHIQQQIHHHHHH", shdr="IIQQQQIIQQ",
+                          sym="IBBHQQ", sym_order=(0, 1, 3, 4, 5)),
+}
+
+ElfSymbol = namedtuple("ElfSymbol", ["name", "value", "size", "type", "bind",
+                                     "section"])
+
+index_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    -- NULL for files that aren't ELF files, so they aren't read again
+    machine INTEGER
+);
+CREATE TABLE IF NOT EXISTS symbols (
+    name TEXT NOT NULL,
+    -- wrapped to a signed 64 bit int for sqlite
+    value INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    bind TEXT NOT NULL,
+    -- symtab or dynsym
+    section TEXT NOT NULL,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS symbols_name ON symbols(name);
+CREATE INDEX IF NOT EXISTS symbols_file ON symbols(file_id);
+"""
+
+
+def to_sqlite_int(value):
+    # sqlite integers are signed 64 bit, so unsigned 64 bit values wrap
+    if value >= (1 << 63):
+        value -= 1 << 64
+    return value
+
+
+def _c_string(buf, offset):
+    end = buf.find(b"\0", offset)
+    if end == -1:
+        end = len(buf)
+    return buf[offset:end].decode("utf-8", "replace")
+
+
+def parse_elf_symbols(buf):
+    """
+    Return (machine, [ElfSymbol]) for the symbols defined in the .symtab
+    and .dynsym sections of an ELF image in buf, which can be an mmap. A
+    symbol counts as defined when it has a section and a non-zero value.
+    Returns None if buf isn't an ELF image
+    """
+    if len(buf) < 16 or buf[:4] != ELF_MAGIC:
+        return None
+    elf_class = buf[4]
+    order = {ELFDATA2LSB: "<", ELFDATA2MSB: ">"}.get(buf[5])
+    layout = elf_layouts.get(elf_class)
+    if order is None or layout is None:
+        return None
+
+    ehdr = struct.Struct(order + layout.ehdr)
+    (_, machine, _, _, _, shoff, _, _, _, _,
+     shentsize, shnum, _) = ehdr.unpack_from(buf, 16)
+    shdr = struct.Struct(order + layout.shdr)
+    if shoff == 0 or shentsize < shdr.size:
+        return machine, []
+    if shnum == 0:
+        # extended numbering, the real count is in the first section's size
+        shnum = shdr.unpack_from(buf, shoff)[5]
+
+    sections = [shdr.unpack_from(buf, shoff + i * shentsize)
+                for i in range(shnum)]
+    sym = struct.Struct(order + layout.sym)
+    name_i, info_i, shndx_i, value_i, size_i = layout.sym_order
+    # symbol table index -> the section holding the real section indexes
+    # of its symbols whose st_shndx is SHN_XINDEX
+    xindex_sections = {s[6]: s for s in sections if s[1] == SHT_SYMTAB_SHNDX}
+    symbols = []
+    for i, (sh_type, offset, size, link, entsize) in enumerate(
+            (s[1], s[4], s[5], s[6], s[9]) for s in sections):
+        if sh_type not in section_kinds or link >= len(sections):
+            continue
+        if entsize != sym.size or offset + size > len(buf):
+            continue
+        strtab = sections[link]
+        strtab_start = strtab[4]
+        strtab_end = strtab_start + strtab[5]
+        strings = buf[strtab_start:strtab_end]
+        kind = section_kinds[sh_type]
+        xindex = xindex_sections.get(i)
+        for sym_i, entry in enumerate(
+                sym.iter_unpack(buf[offset:offset + size])):
+            shndx = entry[shndx_i]
+            value = entry[value_i]
+            if shndx == SHN_XINDEX:
+                # the section index didn't fit in st_shndx
+                if xindex is None:
+                    continue
+                shndx = struct.unpack_from(order + "I", buf,
+                                           xindex[4] + sym_i * 4)[0]
+            if shndx == SHN_UNDEF or value == 0:
+                continue
+            info = entry[info_i]
+            sym_type = info & 0xf
+            if sym_type in (STT_SECTION, STT_FILE) or not entry[name_i]:
+                continue
+            symbols.append(ElfSymbol(
+                _c_string(strings, entry[name_i]), value, entry[size_i],
+                sym_types.get(sym_type, str(sym_type)),
+                sym_binds.get(info >> 4, str(info >> 4)), kind))
+    return machine, symbols
+
+
+def read_elf_symbols(path):
+    """
+    mmap path and parse its symbols. Returns None if it isn't an ELF file
+    or can't be parsed
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read(4) != ELF_MAGIC:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return parse_elf_symbols(mm)
+    except (OSError, ValueError, struct.error, IndexError) as err:
+        log.debug("unable to parse %s: %s", path, err)
+        return None
+
+
+def _index_file(path):
+    result = read_elf_symbols(path)
+    if result is None:
+        return path, None, []
+    machine, symbols = result
+    return path, machine, symbols
+
+
+def iter_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = os.path.join(root, filename)
+                if not os.path.islink(file_path):
+                    yield os.path.abspath(file_path)
+
+
+def open_index(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(index_schema)
+    return conn
+
+
+def update_index(db_path, paths, jobs=None):
+    """
+    Bring the symbol index at db_path up to date with the files under
+    paths. Files whose mtime and size haven't changed are skipped without
+    being read, and files that were removed from under paths are dropped.
+    Returns the number of files that were parsed and removed
+    """
+    conn = open_index(db_path)
+    indexed = {path: (file_id, mtime_ns, size) for
+               file_id, path, mtime_ns, size in
+               conn.execute("SELECT id, path, mtime_ns, size FROM files")}
+
+    seen = set()
+    stats = {}
+    to_parse = []
+    for path in iter_files(paths):
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = st
+        old = indexed.get(path)
+        if old is not None and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+            continue
+        to_parse.append(path)
+
+    roots = [os.path.abspath(p) for p in paths]
+    removed = [path for path in indexed if path not in seen and
+               any(path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+                   for root in roots)]
+
+    with conn:
+        for path in removed:
+            conn.execute("DELETE FROM files WHERE id = ?", (indexed[path][0],))
+
+        with ProcessPoolExecutor(jobs) as pool:
+            for path, machine, symbols in pool.map(_index_file, to_parse,
+                                                   chunksize=16):
+                st = stats[path]
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                file_id = conn.execute(
+                    "INSERT INTO files (path, mtime_ns, size, machine) "
+                    "VALUES (?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, machine)).lastrowid
+                conn.executemany(
+                    "INSERT INTO symbols (name, value, size, type, bind, "
+                    "section, file_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(s.name, to_sqlite_int(s.value), s.size, s.type, s.bind,
+                      s.section, file_id) for s in symbols])
+    conn.close()
+    return len(to_parse), len(removed)
+
+
+def query_index(db_path, names, glob=False):
+    """
+    Yield (path, ElfSymbol) for every definition of the given symbol names,
+    which are sqlite GLOB patterns if glob is set
+    """
+    conn = open_index(db_path)
+    query = ("SELECT f.path, s.name, s.value, s.size, s.type, s.bind, "
+             "s.section FROM symbols s JOIN files f ON s.file_id = f.id "
+             "WHERE s.name %s ? ORDER BY f.path, s.section, s.name" %
+             ("GLOB" if glob else "="))
+    for name in names:
+        for path, *fields in conn.execute(query, (name,)):
+            sym = ElfSymbol(*fields)
+            yield path, sym._replace(value=sym.value & ((1 << 64) - 1))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("symbols", nargs="*",
+                        help="symbol names to find the defining objects of")
+    parser.add_argument("-i", "--index", default=DEFAULT_INDEX,
+                        help="sqlite index to use, defaults to %(default)s")
+    parser.add_argument("-u", "--update", action="append", default=[],
+                        help="directory or file to (re)index before the "
+                             "lookup, can be repeated")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes to parse files with")
+    parser.add_argument("-g", "--glob", action="store_true", default=False,
+                        help="treat symbols as sqlite GLOB patterns")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False,
+                        help="print every matching symbol instead of just "
+                             "the defining files")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.symbols and not args.update:
+        parser.error("nothing to do, give symbols to look up or --update")
+
+    with script_stats.from_args(args, "elf_sym_index"):
+        run(args)
+
+
+def run(args):
+    if args.update:
+        index_dir = os.path.dirname(os.path.abspath(args.index))
+        os.makedirs(index_dir, exist_ok=True)
+        with script_stats.phase("update"):
+            parsed, removed = update_index(args.index, args.update, args.jobs)
+        log.info("parsed %d files, removed %d", parsed, removed)
+
+    if not os.path.exists(args.index):
+        log.error("no index at %s, run with -u to build one", args.index)
+        sys.exit(1)
+    last_path = None
+    results = script_stats.timed_iter(
+        "query", query_index(args.index, args.symbols, args.glob),
+        measure=None)
+    for path, sym in results:
+        if path != last_path:
+            print(path)
+            last_path = path
+        if args.verbose:
+            print("    %016x %6d %-7s %-6s %-6s %s" %
+                  (sym.value, sym.size, sym.type, sym.bind, sym.section,
+                   sym.name))
+
+
+if __name__ == "__main__":
+    main()
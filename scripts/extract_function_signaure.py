@@ -1,39 +1,446 @@
-
 import subprocess
 import re
 import argparse
+import os
+import sys
+import json
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import script_stats
+
+
+default_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", "~/.cache"),
+                                 "extract_function_signature")
+source_extensions = (".h", ".hh", ".hpp", ".hxx", ".c", ".cc", ".cpp")
+
+
+def preprocess_cache_key(path, compiler, flags):
+    h = hashlib.sha256()
+    h.update(("\0".join([compiler] + list(flags)) + "\0").encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def preprocess(path, compiler="/usr/bin/clang", flags=(), timeout=5,
+               cache_dir=None):
+    """
+    Run the preprocessor over path with its output going straight to a file
+    instead of being buffered in memory, returning the path of that file.
+    If cache_dir is set, output is kept there keyed by the hash of the
+    contents of path plus the compiler and flags, and reused on later runs.
+    Returns the path and whether it is a temporary file that the caller
+    needs to remove
+    """
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        key = preprocess_cache_key(path, compiler, flags)
+        cached_path = os.path.join(cache_dir, key + ".i")
+        if os.path.exists(cached_path):
+            return cached_path, False
+
+    fd, out_path = tempfile.mkstemp(suffix=".i", dir=cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as out_f:
+            proc = subprocess.run([compiler, "-E"] + list(flags) + [path],
+                                  stdout=out_f, stderr=subprocess.DEVNULL,
+                                  timeout=timeout)
+    except BaseException:
+        os.unlink(out_path)
+        raise
+
+    # don't cache output that failed, a missing include might show up later
+    if cache_dir is not None and proc.returncode == 0:
+        os.replace(out_path, cached_path)
+        return cached_path, False
+    return out_path, True
+
+
+# preprocessor linemarker, '# 12 "file.h" 1 3 4'
+linemarker_rexp = re.compile(r'#\s*(?:line\s+)?(\d+)(?:\s+"((?:\\.|[^"\\])*)")?')
+token_rexp = re.compile(r"""
+    [A-Za-z_$][\w$]*
+  | \.\.\.
+  | (?:\d|\.\d)[\w.]*(?:[eEpP][-+][\w.]*)*
+  | "(?:\\.|[^"\\])*"
+  | '(?:\\.|[^'\\])*'
+  | ->|<<=|>>=|<<|>>|&&|\|\||[-+*/%&|^=<>!]=|\+\+|--|\#\#
+  | \S
+""", re.X)
+# tokens that are dropped from declarations entirely
+ignored_tokens = {"__extension__", "__inline", "__inline__", "inline",
+                  "__restrict", "__restrict__", "restrict", "__wur"}
+# tokens that are followed by a parenthesized group that gets dropped
+ignored_groups = {"__attribute__", "__attribute", "__asm__", "__asm", "asm",
+                  "__declspec", "__nonnull", "__THROW", "_Noreturn"}
+storage_classes = {"extern", "static", "_Thread_local", "__thread"}
+c_keywords = {
+    "auto", "break", "case", "char", "const", "continue", "default", "do",
+    "double", "else", "enum", "extern", "float", "for", "goto", "if", "int",
+    "long", "register", "return", "short", "signed", "sizeof", "static",
+    "struct", "switch", "typedef", "union", "unsigned", "void", "volatile",
+    "while", "_Bool", "_Complex", "__typeof__", "typeof", "__typeof",
+    "_Atomic", "_Alignas", "__alignof__", "_Static_assert",
+}
+# placeholder for the contents of a brace block in a declaration
+BODY = "{...}"
+
+
+def join_tokens(tokens):
+    """
+    Join tokens back into C with conventional spacing
+    """
+    out = []
+    prev = None
+    for token in tokens:
+        if prev is not None and not (
+                prev in ("(", "[", "*") or
+                token in (")", "]", ",", "[") or
+                (token == "(" and prev not in (",", "*") and
+                 prev not in storage_classes and prev not in c_keywords)):
+            out.append(" ")
+        out.append(token)
+        prev = token
+    return "".join(out)
+
+
+def iter_declarations(lines):
+    """
+    Tokenize preprocessed source line by line, yielding every top level
+    declaration as (tokens, file, line, is_definition). Brace and paren
+    depth are tracked so that struct bodies and function bodies are skipped
+    (the contents of a brace block are replaced with a single BODY token),
+    and linemarkers are followed to know where each declaration came from
+    """
+    current_file = None
+    current_line = 0
+    tokens = []
+    decl_file = None
+    decl_line = 0
+    brace_depth = 0
+    paren_depth = 0
+
+    for line in lines:
+        stripped = line.lstrip()
+        if stripped.startswith("#"):
+            match = linemarker_rexp.match(stripped)
+            if match is not None:
+                current_line = int(match.group(1))
+                if match.group(2) is not None:
+                    current_file = match.group(2)
+            # other directives (#pragma, #ident) are ignored
+            continue
+
+        line_number = current_line
+        current_line += 1
+        for token in token_rexp.findall(line):
+            if brace_depth > 0:
+                if token == "{":
+                    brace_depth += 1
+                elif token == "}":
+                    brace_depth -= 1
+                    if brace_depth == 0 and paren_depth == 0 and \
+                            len(tokens) > 1 and tokens[-2] == ")":
+                        # a function body, the definition ends here
+                        yield tokens[:-1], decl_file, decl_line, True
+                        tokens = []
+                continue
+
+            if not tokens:
+                decl_file = current_file
+                decl_line = line_number
+
+            if token == "{":
+                brace_depth += 1
+                tokens.append(BODY)
+                continue
+            if token == "(":
+                paren_depth += 1
+            elif token == ")":
+                paren_depth -= 1
+            elif token == ";" and paren_depth == 0:
+                if tokens:
+                    yield tokens, decl_file, decl_line, False
+                tokens = []
+                continue
+            tokens.append(token)
+
+
+def strip_decorations(tokens):
+    """
+    Remove attributes, asm labels and qualifiers that don't matter for a
+    signature
+    """
+    out = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ignored_tokens:
+            i += 1
+            continue
+        if token in ignored_groups:
+            i += 1
+            if i < len(tokens) and tokens[i] == "(":
+                depth = 0
+                while i < len(tokens):
+                    if tokens[i] == "(":
+                        depth += 1
+                    elif tokens[i] == ")":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+                i += 1
+            continue
+        out.append(token)
+        i += 1
+    return out
+
+
+def split_params(tokens):
+    params = []
+    current = []
+    depth = 0
+    for token in tokens:
+        if token in ("(", "["):
+            depth += 1
+        elif token in (")", "]"):
+            depth -= 1
+        elif token == "," and depth == 0:
+            params.append(join_tokens(current))
+            current = []
+            continue
+        current.append(token)
+    if current:
+        params.append(join_tokens(current))
+    if params == ["void"]:
+        return []
+    return params
+
+
+def parse_function(tokens, file=None, line=None, is_definition=False):
+    """
+    Turn the tokens of a declaration into a dict describing the function it
+    declares, or None if it doesn't declare a function. The function name is
+    the first identifier that is directly followed by a parameter list, which
+    also covers functions that return function pointers
+    """
+    tokens = strip_decorations(tokens)
+    if not tokens or tokens[0] == "typedef":
+        return None
+
+    depth = 0
+    name_index = None
+    for i, token in enumerate(tokens[:-1]):
+        if token == "=" and depth == 0:
+            # an initialized variable
+            return None
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif tokens[i + 1] == "(" and token not in c_keywords and \
+                token not in storage_classes and \
+                (token[0].isalpha() or token[0] in "_$"):
+            name_index = i
+            break
+    if name_index is None or BODY in tokens[:name_index]:
+        return None
+
+    # find the end of the parameter list
+    depth = 0
+    end = name_index + 1
+    for end in range(name_index + 1, len(tokens)):
+        if tokens[end] == "(":
+            depth += 1
+        elif tokens[end] == ")":
+            depth -= 1
+            if depth == 0:
+                break
+    param_tokens = tokens[name_index + 2:end]
+
+    storage = [t for t in tokens[:name_index] if t in storage_classes]
+    return_tokens = [t for t in tokens[:name_index] + tokens[end + 1:]
+                     if t not in storage_classes]
+    name = tokens[name_index]
+    params = split_params(param_tokens)
+    signature_tokens = storage + [t for t in tokens if t not in storage_classes]
+    return {
+        "name": name,
+        "return_type": join_tokens(return_tokens),
+        "params": params,
+        "storage": " ".join(storage),
+        "definition": is_definition,
+        "file": file,
+        "line": line,
+        "signature": join_tokens(signature_tokens),
+    }
+
+
+def extract_functions(lines):
+    """
+    Yield a dict for every function declared or defined in preprocessed
+    source. Duplicate declarations from the same place are skipped
+    """
+    seen = set()
+    for tokens, file, line, is_definition in iter_declarations(lines):
+        function = parse_function(tokens, file, line, is_definition)
+        if function is None:
+            continue
+        key = (function["name"], function["file"], function["line"])
+        if key in seen:
+            continue
+        seen.add(key)
+        yield function
+
+
+def iter_source_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, filenames in os.walk(path):
+            dirs.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(source_extensions):
+                    yield os.path.join(root, filename)
+
+
+def process_file(path, compiler, flags, timeout, cache_dir):
+    """
+    Preprocess a single file and extract its functions. Returns the path
+    and the functions, or None if preprocessing failed
+    """
+    try:
+        preprocessed_path, is_temporary = preprocess(path, compiler, flags,
+                                                     timeout, cache_dir)
+    except subprocess.TimeoutExpired:
+        print("%s: preprocessor timed out" % path, file=sys.stderr)
+        return path, None
+    except OSError as err:
+        print("%s: %s" % (path, err), file=sys.stderr)
+        return path, None
+
+    try:
+        with open(preprocessed_path, "r", errors="replace") as f:
+            return path, list(extract_functions(f))
+    finally:
+        if is_temporary:
+            os.unlink(preprocessed_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", nargs="*",
+                        help="files or directories of sources to extract "
+                             "function signatures from")
+    parser.add_argument("--cc", default="/usr/bin/clang",
+                        help="compiler used to preprocess")
+    parser.add_argument("-I", dest="include_dirs", action="append", default=[],
+                        help="include directory to pass to the preprocessor")
+    parser.add_argument("-D", dest="defines", action="append", default=[],
+                        help="macro to define for the preprocessor")
+    parser.add_argument("-t", "--timeout", type=float, default=5,
+                        help="seconds to let each preprocessor run take. "
+                             "0 for no limit")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of preprocessors to run at once")
+    parser.add_argument("--cache-dir", default=default_cache_dir,
+                        type=os.path.expanduser,
+                        help="directory to cache preprocessed output in")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="don't cache preprocessed output")
+    parser.add_argument("--json", action="store_true", default=False,
+                        help="output a json index of function name to "
+                             "declarations (return type, params, source "
+                             "file and line)")
+    parser.add_argument("-o", "--output",
+                        help="write output to this file instead of stdout")
+    parser.add_argument("-f", "--function", action="append", default=[],
+                        help="only output functions with this name")
+    parser.add_argument("--index", type=os.path.expanduser,
+                        help="query a json index written by --json instead "
+                             "of extracting from files")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+    if not args.file and args.index is None:
+        parser.error("file is required without --index")
 
-parser = argparse.ArgumentParser()
-parser.add_argument("file")
-args = parser.parse_args()
+    with script_stats.from_args(args, "extract_function_signaure"):
+        run(args)
 
-proc = subprocess.run(["/usr/bin/clang", "-E", args.file],
-                      capture_output=True, timeout=5)
 
-c = proc.stdout
-c = c.decode()
+def run(args):
+    if args.index is not None:
+        with script_stats.phase("load"), open(args.index, "r") as f:
+            index = json.load(f)
+        # a json index doesn't record which input file each function came
+        # from, so the output is a single group
+        groups = [(None, [f for functions in index.values()
+                          for f in functions])]
+    else:
+        with script_stats.phase("extract"):
+            index, groups = build_index(args)
 
-# cut newlines
-c = re.sub("\n", " ", c)
+    if args.function:
+        index = {k: v for k, v in index.items() if k in args.function}
 
-# squeeze spacing
-c = re.sub("\s+", " ", c)
+    out_f = sys.stdout if args.output is None else open(args.output, "w")
+    with out_f, script_stats.phase("output"):
+        if args.json:
+            json.dump(index, out_f, indent=2)
+            out_f.write("\n")
+            return
+        for path, functions in groups:
+            if args.function:
+                functions = [f for f in functions
+                             if f["name"] in args.function]
+                if not functions:
+                    continue
+            if path is not None and len(groups) > 1:
+                out_f.write("// %s\n" % path)
+            for function in functions:
+                out_f.write(function["signature"] + "\n")
 
-# remove headers
-c = re.sub('#\s+\d+\s+"[^"]+"(\s+\d+)*', "", c)
 
-# TODO: extern check might not always be accurate
-lines = [i for i in c.split(";") if i.find("extern") != -1 and i != '']
+def build_index(args):
+    """
+    Extract the functions from every file given on the command line into a
+    mapping of function name to a list of declarations. Also returns a list
+    of (path, declarations) in the order the files were given, with each
+    declaration under the first file it was found in
+    """
+    flags = ["-I" + i for i in args.include_dirs] + \
+        ["-D" + i for i in args.defines]
+    cache_dir = None if args.no_cache else os.path.abspath(args.cache_dir)
+    timeout = args.timeout if args.timeout > 0 else None
 
+    index = {}
+    groups = []
+    seen = set()
+    paths = list(iter_source_files(args.file))
+    with ThreadPoolExecutor(args.jobs) as pool:
+        results = pool.map(lambda path: process_file(path, args.cc, flags,
+                                                     timeout, cache_dir),
+                           paths)
+        for path, functions in results:
+            if functions is None:
+                continue
+            group = []
+            for function in functions:
+                # headers shared between files are only recorded once
+                key = (function["name"], function["file"], function["line"])
+                if key in seen:
+                    continue
+                seen.add(key)
+                index.setdefault(function["name"], []).append(function)
+                group.append(function)
+            groups.append((path, group))
+    return index, groups
 
-sig_lines = []
-for line in lines:
-    line = re.sub("__(asm|attribute)__\s*\([^)]+\)+", "", line)
-    line = re.sub("__(extension|inline)__", "", line)
-    line = re.sub("__restrict", "", line)
-    # squeeze spacing
-    line = re.sub("\s+", " ", line)
-    sig_lines.append(line.strip())
 
-for line in sig_lines:
-    print(line)
+if __name__ == "__main__":
+    main()
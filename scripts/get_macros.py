@@ -1,113 +1,1159 @@
 #!/usr/bin/env python3
 import re
+import operator
 import argparse
 import os
 import json
+import sys
+import hashlib
+import sqlite3
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument("path", help="path to a file to get macros from",
-                    type=os.path.expanduser)
-parser.add_argument("-s", "--singleline",
-                    default=False, action="store_true",
-                    help="print singleline macros")
-parser.add_argument("-m", "--multiline",
-                    default=False, action="store_true",
-                    help="print multiline macros")
-parser.add_argument("-j", "--dump-json",
-                    default=False, action="store_true",
-                    help="dump out macros as json")
-parser.add_argument("-p", "--python-assignments",
-                    default=False, action="store_true",
-                    help="print out single line macros as assignments "
-                         "compatible with python. strips comments")
-parser.add_argument("-c", "--keep-comments",
-                    default=False, action="store_true",
-                    help="Don't strip comments from output ")
-parser.add_argument("-d", "--keep-defines",
-                    default=False, action="store_true",
-                    help="Keep in '#defines'. Ignored for python")
-parser.add_argument("-i", "--includes",
-                    default=False, action="store_true",
-                    help="Add includes into output "
-                         "(not valid for json)")
-args = parser.parse_args()
-
-
-# (?m)  -- inline MULTILINE FLAG
-# ^#define  -- start of string and literal values
-# (   -- group
-# (?:  -- non captured group
-#    .*\\\r?\n   -- any value 0 or more times, literal \, optional \r, literal \n
-# )*  -- 0 or more of non captured group
-# .*)$  -- the rest of the macro after '#define' if it is single line, or
-#         the rest of the last line of the macro if it is multi line
-rexp = re.compile(r'(?m)^#\s*define\s+((?:.*\\\r?\n)*.*)$')
-multiline_comment_regex = re.compile(r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/")
-include_rexp = re.compile(r'(#\s*include\s+.*)')
-with open(args.path, 'r') as f:
-    content = f.read()
-
-
-matches = [i.groups()[0] for i in re.finditer(rexp, content)]
-# remove most of the whitespace that is present
-matches = [re.sub(r'\\*\s+', ' ', i) for i in matches]
-if args.keep_comments is False:
-    matches = [re.sub(multiline_comment_regex, '', i) for i in matches]
-include_matches = [i.groups()[0] for i in re.finditer(include_rexp, content)]
-
-# separate out the function like macros from the object like
-split_matches = []
-function_like = []
-for i in matches:
-    splt = i.split(' ', 1)
-    if splt[0].find('(') > -1:
-        function_like.append(i)
-    else:
-        split_matches.append(splt)
-
-# split_matches = [i.split(' ', 1) for i in matches]
-macro_map = dict([i if len(i) > 1 else i + [""] for i in split_matches])
-python_repr_macro_map = {k: v for k, v in macro_map.items() if '\n' not in v}
-
-define_string = ''
-if args.keep_defines is True:
-    define_string = '#define '
-
-singleline = []
-multiline = []
-for i in matches:
-    macrostring = define_string + i
-    if '\n' in i:
-        multiline.append(macrostring)
+import script_stats
+
+
+# start of a preprocessor directive that we care about
+directive_rexp = re.compile(r'\s*#\s*(define|include)\b\s*')
+# string and character literals, which can contain things that look like
+# comments, and the start of comments
+comment_token_rexp = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|/\*|//')
+whitespace_rexp = re.compile(r'\s+')
+# the quote style and header name of an include line
+include_name_rexp = re.compile(r'#\s*include\s*([<"])([^>"]+)[>"]')
+
+# kind is "define" or "include". text is the body of a define (name and
+# value) or the whole include line, with whitespace squeezed
+Directive = namedtuple("Directive", ["kind", "text", "multiline", "path", "line"])
+
+
+def strip_comments(line, in_comment, keep_comments=False):
+    """
+    Remove the comments from a single line. in_comment is whether the line
+    starts inside of a block comment. Comments are replaced with a space
+    (or kept as is if keep_comments is set). Returns the new line and
+    whether a block comment is still open at the end of it
+    """
+    if not in_comment and "/" not in line:
+        return line, False
+
+    out = []
+    pos = 0
+    if in_comment:
+        end = line.find("*/")
+        if end == -1:
+            return (line if keep_comments else " "), True
+        out.append(line[:end + 2] if keep_comments else " ")
+        pos = end + 2
+
+    while True:
+        match = comment_token_rexp.search(line, pos)
+        if match is None:
+            out.append(line[pos:])
+            break
+        token = match.group()
+        out.append(line[pos:match.start()])
+        if token == "/*":
+            end = line.find("*/", match.end())
+            if end == -1:
+                out.append(line[match.start():] if keep_comments else " ")
+                return "".join(out), True
+            out.append(line[match.start():end + 2] if keep_comments else " ")
+            pos = end + 2
+        elif token == "//":
+            if keep_comments:
+                out.append(line[match.start():])
+            return "".join(out), False
+        else:
+            out.append(token)
+            pos = match.end()
+    return "".join(out), False
+
+
+def iter_directives(f, keep_comments=False, path=None):
+    """
+    Scan an open header line by line, yielding a Directive for every
+    #define and #include. Continuation lines and comments (including block
+    comments that span lines) are handled as the lines go by, so nothing
+    more than the current directive is ever held in memory
+    """
+    in_comment = False
+    lineno = 0
+    for line in f:
+        lineno += 1
+        if in_comment:
+            _, in_comment = strip_comments(line, in_comment)
+            continue
+        match = directive_rexp.match(line)
+        if match is None:
+            # only needs a closer look if it could open a block comment
+            if "/*" in line:
+                _, in_comment = strip_comments(line, in_comment)
+            continue
+
+        start_line = lineno
+        pieces = []
+        # only continuation lines make a macro multiline, not comments
+        multiline = False
+        while True:
+            text, in_comment = strip_comments(line, in_comment, keep_comments)
+            text = text.rstrip("\r\n")
+            continued = text.endswith("\\")
+            if continued:
+                text = text[:-1]
+                multiline = True
+            pieces.append(text)
+            if not (continued or in_comment):
+                break
+            line = next(f, None)
+            if line is None:
+                break
+            lineno += 1
+
+        kind = match.group(1)
+        if kind == "define":
+            pieces[0] = pieces[0][match.end():]
+        logical = whitespace_rexp.sub(" ", " ".join(pieces)).strip()
+        yield Directive(kind, logical, multiline, path, start_line)
+
+
+def iter_file_directives(paths, keep_comments=False):
+    for path in paths:
+        with open(path, "r", errors="replace") as f:
+            yield from iter_directives(f, keep_comments, path)
+
+
+def split_macro(text):
+    """
+    Split the text of a define into its name and value, and whether it is a
+    function like macro
+    """
+    splt = text.split(" ", 1)
+    name = splt[0]
+    value = splt[1] if len(splt) > 1 else ""
+    return name, value, "(" in name
+
+
+def split_macros(matches):
+    """
+    separate out the function like macros from the object like, returning a
+    mapping of object like macro names to their values and a list of the
+    function like macros
+    """
+    macro_map = {}
+    function_like = []
+    for i in matches:
+        name, value, is_function_like = split_macro(i)
+        if is_function_like:
+            function_like.append(i)
+        else:
+            macro_map[name] = value
+    return macro_map, function_like
+
+
+# tokens of a C integer constant expression
+c_token_rexp = re.compile(r"""
+    (?P<NUM>(?:0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)(?P<SUFFIX>[uUlL]*)(?![\w.]))
+  | (?P<CHAR>'(?:\\.|[^\\'])+')
+  | (?P<IDENT>[A-Za-z_]\w*)
+  | (?P<OP><<|>>|<=|>=|==|!=|&&|\|\||[-+*/%&|^~!<>(),?:])
+  | (?P<SPACE>\s+)
+""", re.X)
+# bodies that are just an integer, which skip the expression parser
+c_int_rexp = re.compile(r"\(?\s*(0[xX][0-9a-fA-F]+|[1-9][0-9]*|0)([uUlL]*)\s*\)?")
+# words that can make up the type in a cast
+c_type_rexp = re.compile(r"^(?:unsigned|signed|int|long|short|char|const|"
+                         r"volatile|size_t|ssize_t|uintptr_t|intptr_t|"
+                         r"__?[us](?:8|16|32|64)|u?int(?:8|16|32|64|max)_t|"
+                         r"__(?:le|be)(?:16|32|64)|__kernel_\w+|\*)$")
+# sizes of types for sizeof, assuming an LP64 target
+c_type_sizes = {
+    "char": 1, "short": 2, "int": 4, "long": 8, "long long": 8,
+    "size_t": 8, "ssize_t": 8, "uintptr_t": 8, "intptr_t": 8, "*": 8,
+}
+c_type_sizes.update({"%s%s%d" % (prefix, sign, bits): bits // 8
+                     for prefix in ["", "__"] for sign in "us"
+                     for bits in [8, 16, 32, 64]})
+c_type_sizes.update({"%sint%d_t" % (sign, bits): bits // 8
+                     for sign in ["", "u"] for bits in [8, 16, 32, 64]})
+# name, parameters and body of a function like macro
+function_macro_rexp = re.compile(r'([A-Za-z_]\w*)\(([^)]*)\)\s*(.*)', re.S)
+call_start_rexp = re.compile(r'\b([A-Za-z_]\w*)\s*\(')
+word_rexp = re.compile(r'\b[A-Za-z_]\w*\b')
+c_char_escapes = {"n": 10, "t": 9, "r": 13, "0": 0, "\\": 92, "'": 39,
+                  '"': 34, "a": 7, "b": 8, "f": 12, "v": 11}
+
+
+def _c_div(a, b):
+    # C division truncates towards 0
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b >= 0) else -q
+
+
+def _c_mod(a, b):
+    return a - _c_div(a, b) * b
+
+
+c_binops = {
+    "*": operator.mul, "/": _c_div, "%": _c_mod,
+    "+": operator.add, "-": operator.sub,
+    "<<": operator.lshift, ">>": operator.rshift,
+    "<": lambda a, b: int(a < b), "<=": lambda a, b: int(a <= b),
+    ">": lambda a, b: int(a > b), ">=": lambda a, b: int(a >= b),
+    "==": lambda a, b: int(a == b), "!=": lambda a, b: int(a != b),
+    "&": operator.and_, "^": operator.xor, "|": operator.or_,
+}
+# binding power of the binary operators, from C's precedence table.
+# && and || are parsed the same way but short circuit when evaluated
+c_binop_precedence = {
+    "*": 10, "/": 10, "%": 10,
+    "+": 9, "-": 9,
+    "<<": 8, ">>": 8,
+    "<": 7, "<=": 7, ">": 7, ">=": 7,
+    "==": 6, "!=": 6,
+    "&": 5,
+    "^": 4,
+    "|": 3,
+    "&&": 2,
+    "||": 1,
+}
+c_unaryops = {
+    "-": operator.neg, "+": operator.pos, "~": operator.invert,
+    "!": lambda a: int(not a),
+}
+# function like macros from the kernel and libc headers that are commonly
+# used to build up constants
+c_builtin_calls = {
+    "_AC": lambda x, _type=None: x,
+    "_UL": lambda x: x,
+    "_ULL": lambda x: x,
+    "UL": lambda x: x,
+    "ULL": lambda x: x,
+    "_BITUL": lambda x: 1 << x,
+    "_BITULL": lambda x: 1 << x,
+    "BIT": lambda x: 1 << x,
+    "BIT_ULL": lambda x: 1 << x,
+}
+
+
+class MacroEvalError(Exception):
+    pass
+
+
+def _c_char_value(literal):
+    body = literal[1:-1]
+    if body.startswith("\\"):
+        if body[1:] in c_char_escapes:
+            return c_char_escapes[body[1:]]
+        if body[1] in "xX":
+            return int(body[2:], 16)
+        return int(body[1:], 8)
+    if len(body) != 1:
+        raise MacroEvalError("unsupported character literal %s" % literal)
+    return ord(body)
+
+
+def _c_sizeof(type_words):
+    words = [w for w in type_words if w not in ("unsigned", "signed",
+                                                 "const", "volatile",
+                                                 "(", ")")]
+    if "*" in words:
+        return c_type_sizes["*"]
+    key = " ".join(words) if words else "int"
+    if key == "long int" or key == "long long int":
+        key = key[:-4]
+    if key == "short int":
+        key = "short"
+    if key not in c_type_sizes:
+        raise MacroEvalError("unknown size of %s" % " ".join(type_words))
+    return c_type_sizes[key]
+
+
+def parse_function_macro(text):
+    """
+    Split the text of a function like define into its name, parameter names
+    and body
+    """
+    match = function_macro_rexp.fullmatch(text)
+    if match is None:
+        return None
+    name, params, body = match.groups()
+    params = [p.strip() for p in params.split(",") if p.strip()]
+    return name, params, body
+
+
+def _split_call_args(text, pos):
+    # split the arguments of a call starting just after its open paren,
+    # returning them and the position after the close paren
+    args = []
+    depth = 0
+    start = pos
+    while pos < len(text):
+        c = text[pos]
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            if depth == 0:
+                args.append(text[start:pos].strip())
+                return args, pos + 1
+            depth -= 1
+        elif c == "," and depth == 0:
+            args.append(text[start:pos].strip())
+            start = pos + 1
+        pos += 1
+    raise MacroEvalError("unterminated call in %r" % text)
+
+
+def expand_function_macros(body, function_macros, depth=0):
+    """
+    Textually expand calls to the function like macros in body. Stringizing
+    and token pasting aren't supported
+    """
+    if depth > 64:
+        raise MacroEvalError("function like macros nested too deeply")
+    out = []
+    pos = 0
+    while True:
+        match = call_start_rexp.search(body, pos)
+        if match is None:
+            out.append(body[pos:])
+            break
+        name = match.group(1)
+        if name not in function_macros:
+            out.append(body[pos:match.end()])
+            pos = match.end()
+            continue
+        params, function_body = function_macros[name]
+        if "#" in function_body:
+            raise MacroEvalError("unsupported # or ## in %s" % name)
+        args, end = _split_call_args(body, match.end())
+        if args == [""] and not params:
+            args = []
+        if len(args) != len(params):
+            raise MacroEvalError("wrong number of arguments to %s" % name)
+        arg_map = dict(zip(params, args))
+        substituted = word_rexp.sub(
+            lambda m: "(%s)" % arg_map[m.group()] if m.group() in arg_map
+            else m.group(), function_body)
+        out.append(body[pos:match.start()])
+        out.append("(%s)" % expand_function_macros(substituted,
+                                                   function_macros, depth + 1))
+        pos = end
+    return "".join(out)
+
+
+def compile_macro(body):
+    """
+    Parse the body of an object like macro into an expression tree with C's
+    operator precedence, dropping integer suffixes and casts along the way.
+    Returns the tree, the width in bits of the widest unsigned type seen (or
+    None) and the names of the macros that the body refers to
+    """
+    match = c_int_rexp.fullmatch(body)
+    if match is not None and (body[0] == "(") == (body[-1] == ")"):
+        suffix = match.group(2).lower()
+        unsigned_width = None
+        if "u" in suffix:
+            unsigned_width = 64 if "l" in suffix else 32
+        value = int(match.group(1), 0)
+        return ("num", value), unsigned_width, []
+
+    tokens = []
+    unsigned_width = None
+    pos = 0
+    while pos < len(body):
+        match = c_token_rexp.match(body, pos)
+        if match is None:
+            raise MacroEvalError("can't tokenize %r" % body[pos:])
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "SUFFIX":
+            kind = "NUM"
+        text = match.group(kind)
+        if kind == "SPACE":
+            continue
+        if kind == "NUM":
+            suffix = match.group("SUFFIX").lower()
+            text = text[:len(text) - len(suffix)]
+            if "u" in suffix:
+                unsigned_width = max(unsigned_width or 0,
+                                     64 if "l" in suffix else 32)
+            if len(text) > 1 and text[0] == "0" and text[1].isdigit():
+                text = int(text, 8)
+            else:
+                text = int(text, 0)
+        elif kind == "CHAR":
+            kind = "NUM"
+            text = _c_char_value(text)
+        tokens.append((kind, text))
+
+    # drop casts, which are parens only containing type words
+    out = []
+    deps = []
+    # name of the function like macro each open paren belongs to (or None)
+    # and whether a comma has been seen inside of it
+    calls = []
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        if text == "(":
+            end = i + 1
+            while end < len(tokens) and tokens[end][1] != ")" and \
+                    tokens[end][0] != "NUM" and \
+                    c_type_rexp.match(tokens[end][1]):
+                end += 1
+            if end > i + 1 and end < len(tokens) and tokens[end][1] == ")" \
+                    and end + 1 < len(tokens):
+                type_words = [t for _, t in tokens[i + 1:end]]
+                if "unsigned" in type_words or \
+                        any(t.startswith(("u", "__u")) for t in type_words):
+                    width = 64 if "long" in type_words or \
+                        any(t.endswith("64") for t in type_words) else 32
+                    unsigned_width = max(unsigned_width or 0, width)
+                i = end + 1
+                continue
+        if text == "sizeof" and i + 1 < len(tokens) and \
+                tokens[i + 1][1] == "(":
+            end = i + 2
+            depth = 1
+            while end < len(tokens):
+                if tokens[end][1] == "(":
+                    depth += 1
+                elif tokens[end][1] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                end += 1
+            out.append(("NUM", _c_sizeof([str(t) for _, t in
+                                          tokens[i + 2:end]])))
+            i = end + 1
+            continue
+        if kind == "IDENT":
+            if i + 1 < len(tokens) and tokens[i + 1][1] == "(":
+                # names used as functions are handled by c_builtin_calls
+                calls.append([text, False])
+                out.append(("CALL", text))
+                out.append(("OP", "("))
+                i += 2
+                continue
+            # the second argument of _AC is a suffix, not a value
+            if calls and calls[-1][0] == "_AC" and calls[-1][1]:
+                kind = "SUFFIX"
+            else:
+                deps.append(text)
+        elif text == "(":
+            calls.append([None, False])
+        elif text == ")":
+            if calls:
+                calls.pop()
+        elif text == ",":
+            if calls:
+                calls[-1][1] = True
+        out.append((kind, text))
+        i += 1
+
+    try:
+        tree, pos = _parse_expr(out, 0)
+        if pos != len(out):
+            raise MacroEvalError("trailing %s" % out[pos][1])
+    except (IndexError, MacroEvalError):
+        raise MacroEvalError("not an integer expression: %s" % body)
+    return tree, unsigned_width, list(dict.fromkeys(deps))
+
+
+def _parse_expr(tokens, pos):
+    # conditional expression, the lowest precedence C has in a constant
+    # expression. Raises MacroEvalError on a syntax error, or IndexError if
+    # the tokens run out
+    cond, pos = _parse_binary(tokens, pos, 1)
+    if pos < len(tokens) and tokens[pos][1] == "?":
+        then, pos = _parse_expr(tokens, pos + 1)
+        if tokens[pos][1] != ":":
+            raise MacroEvalError("expected : in conditional expression")
+        other, pos = _parse_expr(tokens, pos + 1)
+        return ("cond", cond, then, other), pos
+    return cond, pos
+
+
+def _parse_binary(tokens, pos, min_precedence):
+    # precedence climbing over the left associative binary operators
+    left, pos = _parse_unary(tokens, pos)
+    while pos < len(tokens):
+        kind, op = tokens[pos]
+        precedence = c_binop_precedence.get(op) if kind == "OP" else None
+        if precedence is None or precedence < min_precedence:
+            break
+        right, pos = _parse_binary(tokens, pos + 1, precedence + 1)
+        left = ("binary", op, left, right)
+    return left, pos
+
+
+def _parse_unary(tokens, pos):
+    kind, text = tokens[pos]
+    if kind == "NUM":
+        return ("num", text), pos + 1
+    if kind == "IDENT":
+        return ("name", text), pos + 1
+    if kind == "SUFFIX":
+        return ("suffix", text), pos + 1
+    if kind == "OP" and text in c_unaryops:
+        operand, pos = _parse_unary(tokens, pos + 1)
+        return ("unary", text, operand), pos
+    if kind == "OP" and text == "(":
+        node, pos = _parse_expr(tokens, pos + 1)
+        if tokens[pos][1] != ")":
+            raise MacroEvalError("expected )")
+        return node, pos + 1
+    if kind == "CALL":
+        args = []
+        pos += 2
+        if tokens[pos][1] == ")":
+            return ("call", text, args), pos + 1
+        while True:
+            arg, pos = _parse_expr(tokens, pos)
+            args.append(arg)
+            if tokens[pos][1] == ")":
+                return ("call", text, args), pos + 1
+            if tokens[pos][1] != ",":
+                raise MacroEvalError("expected , or ) in call to %s" % text)
+            pos += 1
+    raise MacroEvalError("unexpected %s" % text)
+
+
+def eval_macro_tree(node, values):
+    kind = node[0]
+    if kind == "num":
+        return node[1]
+    if kind == "name":
+        return values[node[1]]
+    if kind == "binary":
+        op = node[1]
+        left = eval_macro_tree(node[2], values)
+        if op == "&&":
+            return int(bool(left) and bool(eval_macro_tree(node[3], values)))
+        if op == "||":
+            return int(bool(left) or bool(eval_macro_tree(node[3], values)))
+        right = eval_macro_tree(node[3], values)
+        try:
+            return c_binops[op](left, right)
+        except (ZeroDivisionError, ValueError) as err:
+            raise MacroEvalError(str(err))
+    if kind == "unary":
+        return c_unaryops[node[1]](eval_macro_tree(node[2], values))
+    if kind == "cond":
+        if eval_macro_tree(node[1], values):
+            return eval_macro_tree(node[2], values)
+        return eval_macro_tree(node[3], values)
+    if kind == "call":
+        name = node[1]
+        if name in c_builtin_calls:
+            # the second argument of _AC is a suffix, not a value
+            args = [None if arg[0] == "suffix" else
+                    eval_macro_tree(arg, values) for arg in node[2]]
+            try:
+                return c_builtin_calls[name](*args)
+            except TypeError as err:
+                raise MacroEvalError(str(err))
+        raise MacroEvalError("unsupported function like macro %s" % name)
+    raise MacroEvalError("unsupported expression")
+
+
+class MacroEvaluator:
+    """
+    Evaluate object like macros to integers, expanding any function like
+    macros they use along the way. Every macro is compiled once and
+    evaluated once, in dependency order, so the whole map is evaluated in
+    time linear in the size of the macro graph. Macros that can't be
+    evaluated end up in errors along with the reason, including macros that
+    depend on them and macros that are part of a cycle
+    """
+    def __init__(self, macro_map, function_macros=None):
+        self.macro_map = macro_map
+        # name -> (params, body) of function like macros that can be
+        # expanded in object like macro bodies
+        self.function_macros = function_macros or {}
+        self.values = {}
+        self.errors = {}
+        self._compiled = {}
+
+    def _compile(self, name):
+        compiled = self._compiled.get(name)
+        if compiled is None:
+            body = self.macro_map[name].strip()
+            if body == "":
+                raise MacroEvalError("empty macro")
+            if self.function_macros:
+                body = expand_function_macros(body, self.function_macros)
+            compiled = compile_macro(body)
+            self._compiled[name] = compiled
+        return compiled
+
+    def _finish(self, name):
+        tree, unsigned_width, deps = self._compiled[name]
+        for dep in deps:
+            if dep in self.errors:
+                raise MacroEvalError("depends on unresolved %s" % dep)
+            dep_width = self._compiled[dep][1]
+            if dep_width is not None:
+                unsigned_width = max(unsigned_width or 0, dep_width)
+        self._compiled[name] = (tree, unsigned_width, deps)
+        value = eval_macro_tree(tree, self.values)
+        if value < 0 and unsigned_width is not None:
+            value &= (1 << unsigned_width) - 1
+        return value
+
+    def evaluate(self, name):
+        """
+        Evaluate name and everything it depends on without recursion, so
+        that deep chains of definitions don't hit the recursion limit
+        """
+        if name in self.values or name in self.errors:
+            return self.values.get(name)
+        if name not in self.macro_map:
+            self.errors[name] = "undefined"
+            return None
+
+        visiting = []
+        on_stack = set()
+        stack = [(name, None)]
+        while stack:
+            current, deps = stack.pop()
+            if deps is None:
+                try:
+                    deps = iter(self._compile(current)[2])
+                except MacroEvalError as err:
+                    self.errors[current] = str(err)
+                    continue
+                visiting.append(current)
+                on_stack.add(current)
+
+            pushed = False
+            for dep in deps:
+                if dep in self.values or dep in self.errors:
+                    continue
+                if dep in on_stack:
+                    cycle = visiting[visiting.index(dep):] + [dep]
+                    for member in cycle[:-1]:
+                        self.errors[member] = "cycle: %s" % " -> ".join(cycle)
+                    continue
+                if dep not in self.macro_map:
+                    self.errors[dep] = "undefined"
+                    continue
+                stack.append((current, deps))
+                stack.append((dep, None))
+                pushed = True
+                break
+            if pushed:
+                continue
+
+            visiting.pop()
+            on_stack.discard(current)
+            if current in self.errors:
+                continue
+            try:
+                self.values[current] = self._finish(current)
+            except MacroEvalError as err:
+                self.errors[current] = str(err)
+        return self.values.get(name)
+
+    def evaluate_body(self, body):
+        """
+        Evaluate a macro body that isn't part of macro_map (like a second
+        definition of a macro) against the macros that are
+        """
+        body = body.strip()
+        if body == "":
+            raise MacroEvalError("empty macro")
+        if self.function_macros:
+            body = expand_function_macros(body, self.function_macros)
+        tree, unsigned_width, deps = compile_macro(body)
+        for dep in deps:
+            self.evaluate(dep)
+            if dep in self.errors:
+                raise MacroEvalError("depends on unresolved %s" % dep)
+            dep_width = self._compiled[dep][1]
+            if dep_width is not None:
+                unsigned_width = max(unsigned_width or 0, dep_width)
+        value = eval_macro_tree(tree, self.values)
+        if value < 0 and unsigned_width is not None:
+            value &= (1 << unsigned_width) - 1
+        return value
+
+    def evaluate_all(self):
+        for name in self.macro_map:
+            self.evaluate(name)
+        return self.values, self.errors
+
+
+def parse_header(path, keep_comments=False):
+    return list(iter_file_directives([path], keep_comments))
+
+
+def resolve_include(include_line, current_dir, include_dirs):
+    """
+    Find the file that an include line refers to. Quoted includes are looked
+    up next to the including file first, then in include_dirs like <> ones
+    """
+    match = include_name_rexp.match(include_line)
+    if match is None:
+        return None
+    quote, name = match.groups()
+    search_dirs = include_dirs
+    if quote == '"':
+        search_dirs = [current_dir] + include_dirs
+    for directory in search_dirs:
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate):
+            return os.path.realpath(candidate)
+    return None
+
+
+def get_sysroot_macros(paths, include_dirs, keep_comments=False, jobs=None):
+    """
+    Parse every header reachable from paths by following includes through
+    include_dirs, visiting each file only once. Headers are parsed on a
+    process pool as they are discovered. Results are merged in the order the
+    headers were discovered so that the output doesn't depend on scheduling.
+    Returns the Directives of all of the headers
+    """
+    discovered = []
+    seen = set()
+    results = {}
+
+    def discover(path):
+        path = os.path.realpath(path)
+        if path in seen:
+            return None
+        seen.add(path)
+        discovered.append(path)
+        return path
+
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = {}
+        for path in paths:
+            path = discover(path)
+            if path is not None:
+                pending[pool.submit(parse_header, path, keep_comments)] = path
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    directives = future.result()
+                except OSError as err:
+                    print("failed to read %s: %s" % (path, err), file=sys.stderr)
+                    continue
+                results[path] = directives
+                current_dir = os.path.dirname(path)
+                for directive in directives:
+                    if directive.kind != "include":
+                        continue
+                    include_path = resolve_include(directive.text, current_dir,
+                                                   include_dirs)
+                    include_path = include_path and discover(include_path)
+                    if include_path is not None:
+                        new_future = pool.submit(parse_header, include_path,
+                                                 keep_comments)
+                        pending[new_future] = include_path
+
+    all_directives = []
+    for path in discovered:
+        if path not in results:
+            continue
+        all_directives.extend(results[path])
+    return all_directives
+
+
+index_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS macros (
+    name TEXT NOT NULL,
+    body TEXT NOT NULL,
+    -- comma separated parameters of function like macros, otherwise NULL
+    params TEXT,
+    -- evaluated value, wrapped to a signed 64 bit int for sqlite
+    value INTEGER,
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS macros_name ON macros(name);
+CREATE INDEX IF NOT EXISTS macros_value ON macros(value);
+CREATE INDEX IF NOT EXISTS macros_file ON macros(file_id);
+"""
+header_extensions = (".h", ".hh", ".hpp", ".hxx")
+
+
+def to_sqlite_int(value):
+    # sqlite integers are signed 64 bit, so unsigned 64 bit values wrap
+    if value is None or not -(1 << 63) <= value < (1 << 64):
+        return None
+    if value >= (1 << 63):
+        value -= 1 << 64
+    return value
+
+
+def iter_header_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.endswith(header_extensions):
+                    yield os.path.abspath(os.path.join(root, filename))
+
+
+def _index_file(path_and_digest, keep_comments=False):
+    """
+    Hash a header and, if its hash differs from the one that is already
+    indexed, parse it. Returns the path, hash and a list of
+    (name, body, params) or None if the contents didn't change
+    """
+    path, old_digest = path_and_digest
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    if digest == old_digest:
+        return path, digest, None
+
+    macros = []
+    for directive in parse_header(path, keep_comments):
+        if directive.kind != "define":
+            continue
+        name, value, is_function_like = split_macro(directive.text)
+        if not is_function_like:
+            macros.append((name, value, None))
+            continue
+        parsed = parse_function_macro(directive.text)
+        if parsed is not None:
+            name, params, body = parsed
+            macros.append((name, body, ",".join(params)))
+    return path, digest, macros
+
+
+def open_index(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(index_schema)
+    return conn
+
+
+def update_index(db_path, paths, keep_comments=False, jobs=None):
+    """
+    Bring the macro index at db_path up to date with the headers under
+    paths. Files whose mtime and size haven't changed are skipped without
+    being read, and files that were touched but have the same hash are not
+    parsed again. Headers that were removed from under paths are dropped.
+    Macro values are re-evaluated over the whole index when anything
+    changed, since macros can depend on ones in other files. Returns the
+    number of files that were parsed and removed
+    """
+    conn = open_index(db_path)
+    indexed = {path: (file_id, mtime_ns, size, digest) for
+               file_id, path, mtime_ns, size, digest in
+               conn.execute("SELECT id, path, mtime_ns, size, sha256 FROM files")}
+
+    seen = set()
+    stats = {}
+    to_check = []
+    for path in iter_header_files(paths):
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = st
+        old = indexed.get(path)
+        if old is not None and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+            continue
+        to_check.append((path, old[3] if old is not None else None))
+
+    roots = [os.path.abspath(p) for p in paths]
+    removed = [path for path in indexed if path not in seen and
+               any(path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+                   for root in roots)]
+
+    parsed = 0
+    with conn:
+        for path in removed:
+            conn.execute("DELETE FROM files WHERE id = ?", (indexed[path][0],))
+
+        index_func = partial(_index_file, keep_comments=keep_comments)
+        with ProcessPoolExecutor(jobs) as pool:
+            results = pool.map(index_func, to_check, chunksize=16)
+            for path, digest, macros in results:
+                st = stats[path]
+                if macros is None:
+                    conn.execute("UPDATE files SET mtime_ns = ?, size = ? "
+                                 "WHERE path = ?",
+                                 (st.st_mtime_ns, st.st_size, path))
+                    continue
+                parsed += 1
+                conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                file_id = conn.execute(
+                    "INSERT INTO files (path, mtime_ns, size, sha256) "
+                    "VALUES (?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, digest)).lastrowid
+                conn.executemany(
+                    "INSERT INTO macros (name, body, params, file_id) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(name, body, params, file_id) for name, body, params in macros])
+
+        if parsed or removed:
+            evaluate_index(conn)
+    conn.close()
+    return parsed, len(removed)
+
+
+def evaluate_index(conn):
+    """
+    Evaluate every object like macro in the index. The last definition of a
+    name (by path) is the one other macros see, but every definition gets
+    its own value
+    """
+    macro_map = {}
+    function_macros = {}
+    rows = conn.execute("SELECT m.rowid, m.name, m.body, m.params FROM macros m "
+                        "JOIN files f ON m.file_id = f.id "
+                        "ORDER BY f.path, m.rowid").fetchall()
+    for _, name, body, params in rows:
+        if params is None:
+            macro_map[name] = body
+        else:
+            function_macros[name] = ([p for p in params.split(",") if p], body)
+    evaluator = MacroEvaluator(macro_map, function_macros)
+    values, _ = evaluator.evaluate_all()
+
+    updates = []
+    for rowid, name, body, params in rows:
+        if params is not None:
+            continue
+        if macro_map[name] == body:
+            value = values.get(name)
+        else:
+            try:
+                value = evaluator.evaluate_body(body)
+            except MacroEvalError:
+                value = None
+        updates.append((to_sqlite_int(value), rowid))
+    conn.executemany("UPDATE macros SET value = ? WHERE rowid = ?", updates)
+
+
+def query_index(db_path, names=(), values=()):
+    """
+    Yield (name, body, value, path) for every macro in the index with one
+    of the given names or evaluated values
+    """
+    conn = open_index(db_path)
+    query = ("SELECT m.name, m.body, m.value, f.path FROM macros m "
+             "JOIN files f ON m.file_id = f.id WHERE m.params IS NULL AND ")
+    for name in names:
+        yield from conn.execute(query + "m.name = ?", (name,))
+    for value in values:
+        yield from conn.execute(query + "m.value = ? ORDER BY m.name",
+                                (to_sqlite_int(value),))
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("path", nargs="*",
+                        help="path to a file to get macros from. With "
+                             "--index, files or directories of headers to "
+                             "add to the index",
+                        type=os.path.expanduser)
+    parser.add_argument("-s", "--singleline",
+                        default=False, action="store_true",
+                        help="print singleline macros")
+    parser.add_argument("-m", "--multiline",
+                        default=False, action="store_true",
+                        help="print multiline macros")
+    parser.add_argument("-j", "--dump-json",
+                        default=False, action="store_true",
+                        help="dump out macros as json")
+    parser.add_argument("-p", "--python-assignments",
+                        default=False, action="store_true",
+                        help="print out single line macros as assignments "
+                             "compatible with python. strips comments")
+    parser.add_argument("-c", "--keep-comments",
+                        default=False, action="store_true",
+                        help="Don't strip comments from output ")
+    parser.add_argument("-d", "--keep-defines",
+                        default=False, action="store_true",
+                        help="Keep in '#defines'. Ignored for python")
+    parser.add_argument("-i", "--includes",
+                        default=False, action="store_true",
+                        help="Add includes into output "
+                             "(not valid for json)")
+    parser.add_argument("-r", "--recursive",
+                        default=False, action="store_true",
+                        help="follow includes through the include "
+                             "directories and merge all of the macros found")
+    parser.add_argument("--sysroot", type=os.path.expanduser,
+                        help="root to search for includes in. Adds "
+                             "<sysroot>/usr/local/include and "
+                             "<sysroot>/usr/include to the include "
+                             "directories. Implies -r")
+    parser.add_argument("-I", "--include-dir", action="append", default=[],
+                        dest="include_dirs", type=os.path.expanduser,
+                        help="directory to search for includes in. Implies -r")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of processes to parse headers with "
+                             "when following includes")
+    parser.add_argument("-e", "--evaluate",
+                        default=False, action="store_true",
+                        help="evaluate object like macros to integers for "
+                             "json and python output. Macros that can't be "
+                             "evaluated are reported on stderr")
+    parser.add_argument("--sources",
+                        default=False, action="store_true",
+                        help="record the file each macro came from in json "
+                             "and python output")
+    parser.add_argument("--index", type=os.path.expanduser,
+                        help="sqlite macro index to update with the headers "
+                             "in path and/or query with --lookup/--reverse")
+    parser.add_argument("--lookup", action="append", default=[],
+                        help="print the definitions of a macro in the index")
+    parser.add_argument("--reverse", action="append", default=[],
+                        type=partial(int, base=0),
+                        help="print every macro in the index that "
+                             "evaluates to this value")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    with script_stats.from_args(args, "get_macros"):
+        run(args, parser)
+
+
+def run(args, parser):
+    if args.index is not None:
+        if args.path:
+            with script_stats.phase("index"):
+                parsed, removed = update_index(args.index, args.path,
+                                               args.keep_comments, args.jobs)
+            if not (args.lookup or args.reverse):
+                print("parsed %d headers, removed %d" % (parsed, removed))
+        with script_stats.phase("query"):
+            rows = list(query_index(args.index, args.lookup, args.reverse))
+        for name, body, value, path in rows:
+            value_str = "" if value is None else " (%#x)" % value
+            print("%s = %s%s  %s" % (name, body, value_str, path))
+        return
+    if not args.path:
+        parser.error("path is required without --index")
+
+    include_dirs = list(args.include_dirs)
+    if args.sysroot is not None:
+        include_dirs += [os.path.join(args.sysroot, "usr", "local", "include"),
+                         os.path.join(args.sysroot, "usr", "include")]
+    recursive = args.recursive or len(include_dirs) > 0
+
+    if recursive:
+        with script_stats.phase("parse"):
+            all_directives = get_sysroot_macros(
+                args.path, include_dirs, args.keep_comments, args.jobs)
+        directives = lambda: iter(all_directives)
     else:
-        singleline.append(macrostring)
+        # every output mode makes its own pass over the files so that the
+        # directives never have to be held in memory all at once
+        directives = lambda: script_stats.timed_iter(
+            "parse", iter_file_directives(args.path, args.keep_comments),
+            measure=None)
+
+    define_string = ''
+    if args.keep_defines is True:
+        define_string = '#define '
+
+    if args.includes is True:
+        for directive in directives():
+            if directive.kind == "include":
+                print(directive.text)
+        print("")
+
+    if args.singleline is True:
+        for directive in directives():
+            if directive.kind == "define" and not directive.multiline:
+                print(define_string + directive.text)
+        print()
 
+    if args.multiline is True:
+        for directive in directives():
+            if directive.kind == "define" and directive.multiline:
+                print(define_string + directive.text)
 
-if args.includes is True:
-    for i in include_matches:
-        print('%s' % i)
-    print("")
+    if not (args.dump_json or args.python_assignments):
+        return
 
-if args.singleline is True:
-    for i in singleline:
-        print(i)
-    print()
+    macro_map = {}
+    macro_sources = {}
+    function_like = []
+    function_macros = {}
+    for directive in directives():
+        if directive.kind != "define":
+            continue
+        name, value, is_function_like = split_macro(directive.text)
+        if is_function_like:
+            function_like.append(directive.text)
+            parsed = parse_function_macro(directive.text)
+            if parsed is not None:
+                function_macros[parsed[0]] = parsed[1:]
+            continue
+        macro_map[name] = value
+        macro_sources[name] = directive.path
 
-if args.multiline is True:
-    for i in multiline:
-        print(i)
+    values = {}
+    errors = {}
+    if args.evaluate is True:
+        with script_stats.phase("evaluate"):
+            values, errors = MacroEvaluator(macro_map,
+                                            function_macros).evaluate_all()
+        for name, reason in errors.items():
+            if macro_map.get(name, "").strip() != "":
+                print("unresolved %s: %s" % (name, reason), file=sys.stderr)
 
-if args.dump_json is True:
-    print(json.dumps(macro_map, indent=2))
+    if args.dump_json is True:
+        json_map = macro_map
+        if args.evaluate is True:
+            json_map = {k: values.get(k, v) for k, v in macro_map.items()}
+        if args.sources is True:
+            print(json.dumps({k: {"value": v, "file": macro_sources.get(k)}
+                              for k, v in json_map.items()}, indent=2))
+        else:
+            print(json.dumps(json_map, indent=2))
 
-if args.python_assignments is True:
-    for k, v in python_repr_macro_map.items():
-        if v == "":
-            v = "None"
-        print("%s = %s" % (k, v))
-    print("\n# Function like macros")
-    for i in function_like:
-        print("# %s" % i)
+    if args.python_assignments is True:
+        current_source = None
+        for k, v in macro_map.items():
+            if args.sources is True and macro_sources.get(k) != current_source:
+                current_source = macro_sources.get(k)
+                print("\n# %s" % current_source)
+            if args.evaluate is True:
+                if k in values:
+                    print("%s = %d" % (k, values[k]))
+                elif v.strip() == "":
+                    print("%s = None" % k)
+                else:
+                    print("# %s = %s" % (k, v))
+                continue
+            if v == "":
+                v = "None"
+            print("%s = %s" % (k, v))
+        print("\n# Function like macros")
+        for i in function_like:
+            print("# %s" % i)
 
 
+if __name__ == "__main__":
+    main()
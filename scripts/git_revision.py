@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Sync the git repos nested under a project (like chromium's, which aren't
+submodules) to the commit that was current at the date of the top level
+repo's HEAD commit. A parallel version of git_revision.sh
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import script_stats
+
+log = logging.getLogger("git_revision")
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(levelname)-7s | %(message)s"))
+log.addHandler(handler)
+log.setLevel(logging.INFO)
+
+RepoResult = namedtuple("RepoResult", ["path", "status", "current", "target",
+                                       "seconds", "error"])
+
+
+def git(path, *args):
+    proc = subprocess.run(["git", "-C", path] + list(args),
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args,
+                                            proc.stdout, proc.stderr)
+    return proc.stdout.strip()
+
+
+def find_repos(root):
+    """
+    Yield every directory under root, not including root itself, that has a
+    .git directory. The .git directories themselves are never walked into
+    """
+    for dirpath, dirnames, _ in os.walk(root):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+            if dirpath != root:
+                yield dirpath
+        dirnames.sort()
+
+
+def sync_repo(path, date, dry_run=False):
+    """
+    Check out the newest commit of the repo at path from before date, on any
+    ref. With dry_run only work out what would be checked out
+    """
+    start = time.perf_counter()
+    current = target = None
+    try:
+        # --all includes tags, so commits only reachable from a tag count
+        target = git(path, "rev-list", "--max-count=1", "--all",
+                     "--before=%s" % date) or None
+        try:
+            current = git(path, "rev-parse", "HEAD")
+        except subprocess.CalledProcessError:
+            current = None
+        if target is None:
+            status = "no-commit"
+        elif target == current:
+            status = "up-to-date"
+        elif dry_run:
+            status = "would-checkout"
+        else:
+            git(path, "checkout", "-q", target)
+            status = "checked-out"
+        error = None
+    except (OSError, subprocess.CalledProcessError) as err:
+        status = "error"
+        error = getattr(err, "stderr", None) or str(err)
+        error = error.strip()
+    return RepoResult(path, status, current, target,
+                      time.perf_counter() - start, error)
+
+
+def sync_repos(root, date, jobs=8, dry_run=False):
+    """
+    Sync every nested repo under root on a pool of jobs threads, yielding
+    RepoResults as they finish
+    """
+    with ThreadPoolExecutor(jobs) as pool:
+        futures = [pool.submit(sync_repo, path, date, dry_run)
+                   for path in find_repos(root)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def short(commit):
+    return commit[:12] if commit else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", nargs="?", default=".",
+                        help="top level repo, defaults to .")
+    parser.add_argument("-d", "--date",
+                        help="date to sync to instead of the date of the top "
+                             "level repo's HEAD commit")
+    parser.add_argument("-j", "--jobs", type=int, default=8,
+                        help="number of repos to sync at once")
+    parser.add_argument("-n", "--dry-run", action="store_true", default=False,
+                        help="only print the commit each repo would be "
+                             "checked out at")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    with script_stats.from_args(args, "git_revision"):
+        run(args)
+
+
+def run(args):
+    root = os.path.normpath(args.root)
+    date = args.date
+    if date is None:
+        try:
+            date = git(root, "show", "-s", "--format=%ci")
+        except (OSError, subprocess.CalledProcessError) as err:
+            error = getattr(err, "stderr", None) or str(err)
+            log.error("can't get the date of %s's HEAD commit: %s", root,
+                      error.strip())
+            sys.exit(1)
+    log.info("syncing repos under %s to %s%s", root, date,
+             " (dry run)" if args.dry_run else "")
+
+    start = time.perf_counter()
+    results = []
+    results_iter = script_stats.timed_iter(
+        "sync", sync_repos(root, date, args.jobs, args.dry_run), measure=None)
+    for result in results_iter:
+        results.append(result)
+        if result.status == "error":
+            log.error("%s: %s", result.path, result.error)
+        else:
+            log.debug("%s: %s", result.path, result.status)
+    elapsed = time.perf_counter() - start
+
+    counts = {}
+    for result in sorted(results):
+        counts[result.status] = counts.get(result.status, 0) + 1
+        print("%-14s %7.2fs %-12s -> %-12s %s" %
+              (result.status, result.seconds, short(result.current),
+               short(result.target), os.path.relpath(result.path, root)))
+    print("%d repos in %.2fs: %s" %
+          (len(results), elapsed,
+           ", ".join("%d %s" % (v, k) for k, v in sorted(counts.items()))))
+    if counts.get("error"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
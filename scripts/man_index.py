@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Full text search over man pages through a persistent inverted index, for
+when all_man_refs (man -K) is too slow. Prints whatis lines for every page
+that mentions all of the given terms
+"""
+import os
+import re
+import bz2
+import gzip
+import lzma
+import shutil
+import sqlite3
+import logging
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import script_stats
+
+log = logging.getLogger("man_index")
+log.addHandler(logging.StreamHandler())
+log.setLevel(logging.INFO)
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser("~"), ".cache",
+                             "man_index.sqlite")
+DEFAULT_MANPATH = ["/usr/local/share/man", "/usr/share/man"]
+
+openers = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open,
+           ".lzma": lzma.open}
+page_rexp = re.compile(r"^(?P<NAME>.+)\.(?P<SECTION>\d\w*|n|l)"
+                       r"(?P<COMP>\.gz|\.bz2|\.xz|\.lzma)?$")
+# font changes join the text around them, everything else is a separator
+font_rexp = re.compile(r"\\f(?:\[[^\]]*\]|\(..|.)|\\[,/&]")
+escape_rexp = re.compile(r"\\(?:\(..|\[[^\]]*\]|\*(?:\(..|\[[^\]]*\]|.)|"
+                         r"s[-+]?\d+|.)")
+term_rexp = re.compile(r"[a-z0-9_]{2,}")
+section_header_rexp = re.compile(r'^\.(?:SH|Sh)\s+"?([^"]*)"?\s*$')
+# the NAME section is only its first paragraph, generated pages sometimes
+# put a whole table of contents after it
+name_end_macros = {".SS", ".PP", ".P", ".LP", ".IP", ".TP", ".HP", ".sp",
+                   ".INDENT", ".nf", ".TS"}
+
+index_schema = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    section TEXT NOT NULL,
+    whatis TEXT
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL REFERENCES terms(id),
+    page_id INTEGER NOT NULL REFERENCES pages(id) ON DELETE CASCADE,
+    PRIMARY KEY (term_id, page_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_page ON postings(page_id);
+-- the manpath directories and man<section> directories in them, as of the
+-- last update. Pages being added or removed changes their mtime
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL
+);
+"""
+
+
+def get_manpath():
+    """
+    The directories man searches, from $MANPATH or manpath(1) if available
+    """
+    manpath = os.environ.get("MANPATH")
+    if not manpath and shutil.which("manpath"):
+        try:
+            manpath = subprocess.run(["manpath", "-q"], capture_output=True,
+                                     text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            manpath = None
+    if not manpath:
+        return [p for p in DEFAULT_MANPATH if os.path.isdir(p)]
+    return [p for p in manpath.split(":") if p]
+
+
+def iter_pages(manpath):
+    """
+    Yield the path of every man page in the man<section> directories of
+    manpath. Symlinked pages are skipped since they point at a page that is
+    indexed already
+    """
+    for root in manpath:
+        try:
+            section_dirs = sorted(e.path for e in os.scandir(root)
+                                  if e.is_dir() and e.name.startswith("man"))
+        except OSError:
+            continue
+        for section_dir in section_dirs:
+            with os.scandir(section_dir) as it:
+                for entry in it:
+                    if entry.is_file(follow_symlinks=False) and \
+                            page_rexp.match(entry.name):
+                        yield os.path.abspath(entry.path)
+
+
+def manpath_dirs(manpath):
+    """
+    Map every directory in manpath and the man<section> directories in
+    them to their mtime. Directories that don't exist map to -1 so that
+    one appearing is noticed
+    """
+    dirs = {}
+    for root in manpath:
+        root = os.path.abspath(root)
+        try:
+            dirs[root] = os.stat(root).st_mtime_ns
+            with os.scandir(root) as it:
+                for entry in it:
+                    if entry.name.startswith("man") and entry.is_dir():
+                        dirs[entry.path] = entry.stat().st_mtime_ns
+        except OSError:
+            dirs.setdefault(root, -1)
+    return dirs
+
+
+def index_is_stale(db_path, manpath):
+    """
+    Whether the manpath changed, or pages were added to or removed from
+    it, since the index at db_path was last updated. Pages edited in place
+    aren't noticed, -u catches those
+    """
+    conn = open_index(db_path)
+    indexed = dict(conn.execute("SELECT path, mtime_ns FROM dirs"))
+    conn.close()
+    return indexed != manpath_dirs(manpath)
+
+
+def read_page(path):
+    ext = os.path.splitext(path)[1]
+    with openers.get(ext, open)(path, "rb") as f:
+        return f.read().decode("utf-8", "replace")
+
+
+def strip_roff(line):
+    line = line.replace("\\-", "-").replace("\\e", "\\")
+    line = font_rexp.sub("", line)
+    return escape_rexp.sub(" ", line)
+
+
+def parse_page(text, name, section):
+    """
+    Return (whatis, terms) for the roff source of a page. whatis is built
+    from the NAME section like man -f prints it
+    """
+    terms = set()
+    name_lines = []
+    in_name = False
+    for line in text.splitlines():
+        if line.startswith(('.\\"', "'\\\"")):
+            continue
+        header = section_header_rexp.match(line)
+        if header is not None:
+            in_name = header.group(1).strip().upper() == "NAME"
+            continue
+        if line.startswith((".", "'")):
+            # keep the text of macros like .B foo, drop the macro itself
+            macro, _, line = line.partition(" ")
+            if macro in name_end_macros:
+                in_name = False
+        line = strip_roff(line)
+        if in_name:
+            name_lines.append(line.strip())
+        terms.update(term_rexp.findall(line.lower()))
+
+    whatis = None
+    name_text = " ".join(i for i in name_lines if i)
+    if name_text:
+        names, sep, desc = name_text.partition(" - ")
+        if not sep:
+            # mdoc pages have the description in .Nd, which was partitioned
+            # off above, so it is just the rest of the text
+            names, _, desc = name_text.partition(" ")
+        names = ", ".join(n.strip() for n in names.split(",") if n.strip())
+        whatis = "%s (%s) - %s" % (names or name, section, desc.strip())
+    return whatis, terms
+
+
+def _index_page(path):
+    match = page_rexp.match(os.path.basename(path))
+    name, section = match.group("NAME"), match.group("SECTION")
+    try:
+        text = read_page(path)
+    except (OSError, EOFError, lzma.LZMAError, ValueError) as err:
+        log.debug("unable to read %s: %s", path, err)
+        return path, name, section, None, []
+    whatis, terms = parse_page(text, name, section)
+    return path, name, section, whatis, sorted(terms)
+
+
+def open_index(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.executescript(index_schema)
+    return conn
+
+
+def update_index(db_path, manpath, jobs=None):
+    """
+    Bring the index at db_path up to date with the pages in manpath. Pages
+    whose mtime and size haven't changed are skipped, pages that are gone
+    are dropped. Returns the number of pages parsed and removed
+    """
+    conn = open_index(db_path)
+    # taken before the pages are listed, so a page added while updating
+    # makes the next run update again rather than be missed
+    dirs = manpath_dirs(manpath)
+    indexed = {path: (page_id, mtime_ns, size) for
+               page_id, path, mtime_ns, size in
+               conn.execute("SELECT id, path, mtime_ns, size FROM pages")}
+
+    stats = {}
+    to_parse = []
+    for path in iter_pages(manpath):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = st
+        old = indexed.get(path)
+        if old is not None and old[1] == st.st_mtime_ns and old[2] == st.st_size:
+            continue
+        to_parse.append(path)
+    removed = [path for path in indexed if path not in stats]
+
+    term_ids = dict(conn.execute("SELECT term, id FROM terms"))
+    with conn:
+        for path in removed:
+            conn.execute("DELETE FROM pages WHERE id = ?", (indexed[path][0],))
+
+        with ProcessPoolExecutor(jobs) as pool:
+            for path, name, section, whatis, terms in pool.map(
+                    _index_page, to_parse, chunksize=32):
+                st = stats[path]
+                conn.execute("DELETE FROM pages WHERE path = ?", (path,))
+                page_id = conn.execute(
+                    "INSERT INTO pages (path, mtime_ns, size, name, section, "
+                    "whatis) VALUES (?, ?, ?, ?, ?, ?)",
+                    (path, st.st_mtime_ns, st.st_size, name, section,
+                     whatis)).lastrowid
+                postings = []
+                for term in terms:
+                    term_id = term_ids.get(term)
+                    if term_id is None:
+                        term_id = conn.execute(
+                            "INSERT INTO terms (term) VALUES (?)",
+                            (term,)).lastrowid
+                        term_ids[term] = term_id
+                    postings.append((term_id, page_id))
+                conn.executemany("INSERT INTO postings (term_id, page_id) "
+                                 "VALUES (?, ?)", postings)
+        conn.execute("DELETE FROM dirs")
+        conn.executemany("INSERT INTO dirs (path, mtime_ns) VALUES (?, ?)",
+                         dirs.items())
+    conn.close()
+    return len(to_parse), len(removed)
+
+
+def query_index(db_path, terms, section=None):
+    """
+    Yield (name, section, whatis, path) for every page containing all of
+    terms. A term ending in * matches any term with that prefix
+    """
+    conn = open_index(db_path)
+    selects = []
+    params = []
+    for term in terms:
+        term = term.lower()
+        if term.endswith("*"):
+            prefix = term[:-1]
+            selects.append("SELECT p.page_id FROM postings p JOIN terms t "
+                           "ON p.term_id = t.id WHERE t.term >= ? AND "
+                           "t.term < ?")
+            params.extend([prefix, prefix + "\uffff"])
+        else:
+            selects.append("SELECT p.page_id FROM postings p JOIN terms t "
+                           "ON p.term_id = t.id WHERE t.term = ?")
+            params.append(term)
+
+    query = ("SELECT name, section, whatis, path FROM pages WHERE id IN (%s)"
+             % " INTERSECT ".join(selects))
+    if section is not None:
+        query += " AND section LIKE ?"
+        params.append(section + "%")
+    query += " ORDER BY section, name"
+    yield from conn.execute(query, params)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("terms", nargs="*",
+                        help="words that have to appear in the page, "
+                             "word* matches a prefix")
+    parser.add_argument("-s", "--section",
+                        help="only show pages in this section")
+    parser.add_argument("-i", "--index", default=DEFAULT_INDEX,
+                        help="sqlite index to use, defaults to %(default)s")
+    parser.add_argument("-u", "--update", action="store_true", default=False,
+                        help="update the index from the manpath first. This "
+                             "happens automatically if there is no index or "
+                             "pages were added or removed, -u also catches "
+                             "pages edited in place")
+    parser.add_argument("-M", "--manpath",
+                        help="colon separated directories to index instead "
+                             "of the manpath")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes to parse pages with")
+    parser.add_argument("-p", "--paths", action="store_true", default=False,
+                        help="print the paths of the pages instead of whatis "
+                             "lines")
+    script_stats.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.terms and not args.update:
+        parser.error("nothing to do, give terms to search for or --update")
+
+    with script_stats.from_args(args, "man_index"):
+        run(args)
+
+
+def run(args):
+    manpath = args.manpath.split(":") if args.manpath else get_manpath()
+    update = args.update or not os.path.exists(args.index)
+    if not update:
+        with script_stats.phase("check"):
+            update = index_is_stale(args.index, manpath)
+        if update:
+            log.info("the manpath changed, updating the index")
+    if update:
+        os.makedirs(os.path.dirname(os.path.abspath(args.index)),
+                    exist_ok=True)
+        with script_stats.phase("update"):
+            parsed, removed = update_index(args.index, manpath, args.jobs)
+        log.info("parsed %d pages, removed %d", parsed, removed)
+
+    if not args.terms:
+        return
+    seen = set()
+    results = script_stats.timed_iter(
+        "query", query_index(args.index, args.terms, args.section),
+        measure=None)
+    for name, section, whatis, path in results:
+        line = path if args.paths else whatis or "%s (%s)" % (name, section)
+        if line not in seen:
+            seen.add(line)
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
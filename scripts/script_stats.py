@@ -0,0 +1,299 @@
+"""
+Optional instrumentation shared by the scripts in this directory. A script
+adds the --stats, --stats-file and --profile options with add_arguments and
+runs its main work inside `with from_args(args, name):`. Code anywhere in
+the script can then time phases with `with script_stats.phase("read"):` or
+wrap an iterator in timed_iter, and count bytes and items processed.
+
+Phase times are exclusive: time spent in a phase that is entered from
+inside another one (including by pulling on a timed_iter) is only counted
+for the inner phase, so reading, compressing and checksumming a stream of
+chunks can be told apart even though they are interleaved.
+
+When none of the options are given everything goes through NullStats,
+which does nothing: phase returns a shared no-op context manager and
+timed_iter returns the iterator it was given.
+"""
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, nbytes=0, items=0):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class NullStats:
+    """
+    Stand in for Stats when instrumentation is off
+    """
+    enabled = False
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def count(self, name, nbytes=0, items=0):
+        pass
+
+    def timed_iter(self, name, iterable, measure=len):
+        return iterable
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STATS = NullStats()
+_active = NULL_STATS
+
+
+class PhaseRecord:
+    __slots__ = ("name", "calls", "wall", "cpu", "bytes", "items")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.bytes = 0
+        self.items = 0
+
+    def as_dict(self):
+        return {"calls": self.calls, "wall": round(self.wall, 6),
+                "cpu": round(self.cpu, 6), "bytes": self.bytes,
+                "items": self.items}
+
+
+class _Phase:
+    __slots__ = ("stats", "record")
+
+    def __init__(self, stats, record):
+        self.stats = stats
+        self.record = record
+
+    def __enter__(self):
+        self.stats._push(self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats._pop()
+        return False
+
+    def add(self, nbytes=0, items=0):
+        self.record.bytes += nbytes
+        self.record.items += items
+
+
+class Stats:
+    """
+    Per phase wall time, cpu time, bytes and items for one run of a script,
+    reported on exit along with the totals and peak RSS. stats_file is
+    where the json report goes, or None for a table on stderr. profile is
+    where to dump cProfile stats, - for the top functions on stderr
+    """
+    enabled = True
+
+    def __init__(self, name, stats_file=None, profile=None):
+        self.name = name
+        self.stats_file = stats_file
+        self.profile = profile
+        self.phases = {}
+        # [record, wall start, cpu start] of the phases that are entered
+        self._stack = []
+        self._profiler = None
+        self._previous = None
+        self._start_wall = self._start_cpu = self._start_children = 0.0
+
+    def _record(self, name):
+        record = self.phases.get(name)
+        if record is None:
+            record = self.phases[name] = PhaseRecord(name)
+        return record
+
+    def _push(self, record):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if self._stack:
+            # pause the enclosing phase
+            parent = self._stack[-1]
+            parent[0].wall += wall - parent[1]
+            parent[0].cpu += cpu - parent[2]
+        record.calls += 1
+        self._stack.append([record, wall, cpu])
+
+    def _pop(self):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        record, start_wall, start_cpu = self._stack.pop()
+        record.wall += wall - start_wall
+        record.cpu += cpu - start_cpu
+        if self._stack:
+            # resume the enclosing phase
+            self._stack[-1][1] = wall
+            self._stack[-1][2] = cpu
+
+    def phase(self, name):
+        return _Phase(self, self._record(name))
+
+    def count(self, name, nbytes=0, items=0):
+        record = self._record(name)
+        record.bytes += nbytes
+        record.items += items
+
+    def timed_iter(self, name, iterable, measure=len):
+        """
+        Yield from iterable, timing each step as the phase name and counting
+        an item per step and measure(item) bytes if measure isn't None
+        """
+        record = self._record(name)
+        it = iter(iterable)
+        while True:
+            self._push(record)
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._pop()
+            record.items += 1
+            if measure is not None:
+                record.bytes += measure(item)
+            yield item
+
+    def __enter__(self):
+        global _active
+        self._previous = _active
+        _active = self
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._start_children = _children_cpu()
+        if self.profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._write_profile()
+        _active = self._previous
+        self.emit()
+        return False
+
+    def _write_profile(self):
+        if self.profile == "-":
+            out = io.StringIO()
+            pstats.Stats(self._profiler, stream=out).sort_stats(
+                "cumulative").print_stats(30)
+            sys.stderr.write(out.getvalue())
+        else:
+            self._profiler.dump_stats(self.profile)
+
+    def report(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {
+            "script": self.name,
+            "argv": sys.argv,
+            "wall": round(time.perf_counter() - self._start_wall, 6),
+            "cpu": round(time.process_time() - self._start_cpu, 6),
+            # worker processes, like the ones compressing or parsing files
+            "children_cpu": round(_children_cpu() - self._start_children, 6),
+            "peak_rss_kb": usage.ru_maxrss,
+            "children_peak_rss_kb": resource.getrusage(
+                resource.RUSAGE_CHILDREN).ru_maxrss,
+            "phases": {name: record.as_dict()
+                       for name, record in self.phases.items()},
+        }
+
+    def emit(self):
+        report = self.report()
+        if self.stats_file is not None:
+            with open(self.stats_file, "w") as f:
+                json.dump(report, f, indent=2)
+            return
+        lines = ["%s: %.3fs wall, %.3fs cpu (+%.3fs in children), peak rss "
+                 "%.1f MB" % (self.name, report["wall"], report["cpu"],
+                              report["children_cpu"],
+                              report["peak_rss_kb"] / 1024)]
+        if self.phases:
+            lines.append("  %-20s %8s %9s %9s %11s %9s %10s" %
+                         ("phase", "calls", "wall", "cpu", "bytes", "MB/s",
+                          "items"))
+        for name, record in self.phases.items():
+            rate = record.bytes / record.wall / 1e6 if record.wall else 0.0
+            lines.append("  %-20s %8d %8.3fs %8.3fs %11d %9.1f %10d" %
+                         (name, record.calls, record.wall, record.cpu,
+                          record.bytes, rate, record.items))
+        sys.stderr.write("\n".join(lines) + "\n")
+
+
+def _children_cpu():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+
+def active():
+    return _active
+
+
+def phase(name):
+    return _active.phase(name)
+
+
+def count(name, nbytes=0, items=0):
+    _active.count(name, nbytes, items)
+
+
+def timed_iter(name, iterable, measure=len):
+    return _active.timed_iter(name, iterable, measure)
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--stats", action="store_true", default=False,
+                       help="print per phase time, bytes processed and peak "
+                            "RSS to stderr on exit")
+    group.add_argument("--stats-file", metavar="FILE",
+                       help="write the --stats report to FILE as json")
+    group.add_argument("--profile", metavar="FILE",
+                       help="dump cProfile stats to FILE, or the top "
+                            "functions to stderr if FILE is -")
+    return group
+
+
+def from_args(args, name):
+    """
+    A Stats for the options added by add_arguments, or NULL_STATS when none
+    of them were given
+    """
+    if not (args.stats or args.stats_file or args.profile):
+        return NULL_STATS
+    stats_file = args.stats_file
+    if not (args.stats or stats_file):
+        # --profile on its own, don't print a stats table as well
+        return _ProfileOnly(name, profile=args.profile)
+    return Stats(name, stats_file, args.profile)
+
+
+class _ProfileOnly(Stats):
+    def emit(self):
+        pass
@@ -1,13 +1,35 @@
 #!/usr/bin/env python3
 import ctypes
-from ctypes import c_uint8, c_uint16, c_uint32, c_uint64, sizeof
+from ctypes import c_uint8, c_uint16, c_uint32, c_uint64
 import struct
 from enum import IntEnum, auto
 import zlib
+import bz2
+import lzma
+import mmap
 import os
-from functools import partial
+import stat
+import sys
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
 import argparse
+import hashlib
+import json
 import logging
+import tempfile
+
+import script_stats
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger(__file__)
 log.addHandler(logging.StreamHandler())
@@ -201,6 +223,17 @@ class IHCompression(IntEnum):
 LZ4F_MAGIC = 0x184D2204	# LZ4 Magic Number
 IH_MAGIC = 0x27051956	# Image Magic Number
 IH_NMLEN = 32	# Image Name Length
+IH_MAGIC_BYTES = struct.pack(">I", IH_MAGIC)
+
+CHUNK_SIZE = 1 << 20
+# size of the independent blocks handed to compression workers
+COMPRESS_BLOCK_SIZE = 1 << 20
+# the most input that is guaranteed to fit in one bzip2 -9 block. A block
+# holds 900000 - 19 bytes after the initial run length encoding, which can
+# grow the input by up to 5/4
+BZ2_BLOCK_SIZE = (900000 - 19) * 4 // 5
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_MASK48 = (1 << 48) - 1
 
 
 def ROUND(a, b):
@@ -228,6 +261,48 @@ class LegacyUImageHeader(ctypes.BigEndianStructure):
     ]
 
 
+# precompiled equivalent of LegacyUImageHeader, used for encoding and
+# decoding headers without going through ctypes
+UIMAGE_HEADER_STRUCT = struct.Struct(">7I4B%ds" % IH_NMLEN)
+UIMAGE_HEADER_SIZE = UIMAGE_HEADER_STRUCT.size
+_HCRC_STRUCT = struct.Struct(">I")
+_HCRC_OFFSET = 4
+_ZERO_HCRC = bytes(_HCRC_STRUCT.size)
+
+UImageHeader = namedtuple("UImageHeader",
+                          [name for name, _ in LegacyUImageHeader._fields_])
+# skips the python level UImageHeader._make when decoding
+_new_uimage_header = partial(tuple.__new__, UImageHeader)
+
+
+def uimage_header_crc(raw_header):
+    """
+    Calculate the ih_hcrc of an encoded header, treating the ih_hcrc field
+    itself as 0
+    """
+    return zlib.crc32(raw_header[:_HCRC_OFFSET] + _ZERO_HCRC +
+                      raw_header[_HCRC_OFFSET + _HCRC_STRUCT.size:
+                                 UIMAGE_HEADER_SIZE])
+
+
+def encode_uimage_header(header):
+    """
+    Encode a UImageHeader, replacing its ih_hcrc with the correct value
+    """
+    raw_header = bytearray(UIMAGE_HEADER_STRUCT.pack(*header))
+    _HCRC_STRUCT.pack_into(raw_header, _HCRC_OFFSET,
+                           uimage_header_crc(raw_header))
+    return bytes(raw_header)
+
+
+def decode_uimage_header(buf, offset=0):
+    """
+    Decode a UImageHeader from buf at offset. ih_name keeps its padding, use
+    rstrip(b"\\x00") to get the name on its own
+    """
+    return _new_uimage_header(UIMAGE_HEADER_STRUCT.unpack_from(buf, offset))
+
+
 class IntEnumArgOptions:
     """
     Generate a list of string options from an int enum class with a simple
@@ -281,9 +356,39 @@ class IntEnumArgOptions:
         # self.option_strings.sort()
 
     def get_value_from_string(self, str_opt):
+        if isinstance(str_opt, self.enum_class):
+            return str_opt
         return self.lookup_mapping[str_opt]
 
 
+# arguments used to build the IntEnumArgOptions for each enum
+_ENUM_ARG_OPTIONS = {
+    IHCompression: ("IH_COMP_", None),
+    IHImageType: ("IH_TYPE_", ["INVALID"]),
+    IHArch: ("IH_ARCH_", ["INVALID"]),
+    IHOS: ("IH_OS_", ["INVALID"]),
+}
+
+
+@lru_cache(maxsize=None)
+def get_arg_options(enum_class):
+    """
+    Build the IntEnumArgOptions for enum_class the first time it is needed
+    """
+    prefix_str, invalid_suffix_list = _ENUM_ARG_OPTIONS[enum_class]
+    return IntEnumArgOptions(enum_class, prefix_str, invalid_suffix_list)
+
+
+def enum_value(enum_class, opt):
+    """
+    Convert an enum member, int or option string into a member of enum_class.
+    Option tables are only built if a string actually has to be looked up
+    """
+    if isinstance(opt, int):
+        return enum_class(opt)
+    return get_arg_options(enum_class).get_value_from_string(opt)
+
+
 def batch(it, sz):
     length = len(it)
     for i in range(0, length, sz):
@@ -342,68 +447,809 @@ class CustomFormatter(argparse.HelpFormatter):
             return ',\n  '.join(parts)
 
 
-def handle_compression(data, compression_type):
+def iter_file_chunks(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield the contents of an open binary file chunk by chunk. A single buffer
+    is reused for every read, so each yielded memoryview is only valid until
+    the next chunk is requested
+    """
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    read_phase = script_stats.phase("read")
+    while True:
+        with read_phase:
+            n = f.readinto(buf)
+        if not n:
+            break
+        read_phase.add(n, 1)
+        yield view[:n]
+
+
+def crc_chunks(chunks):
+    """
+    Calculate the crc32 and total length of an iterable of chunks
+    """
+    data_crc = 0
+    data_size = 0
+    with script_stats.phase("crc") as crc_phase:
+        for chunk in chunks:
+            data_crc = zlib.crc32(chunk, data_crc)
+            data_size += len(chunk)
+        crc_phase.add(data_size)
+    return data_crc, data_size
+
+
+def copy_payload(in_f, out_f, size):
+    """
+    Copy size bytes from the current position of in_f to the current
+    position of out_f. copy_file_range and sendfile are tried first so that
+    the data never has to pass through userspace, falling back to a buffered
+    copy when neither works for the given pair of files
+    """
+    with script_stats.phase("copy") as copy_phase:
+        copied = _copy_payload(in_f, out_f, size)
+        copy_phase.add(copied)
+    return copied
+
+
+def _copy_payload(in_f, out_f, size):
+    out_f.flush()
+    in_fd = in_f.fileno()
+    out_fd = out_f.fileno()
+    in_off = in_f.tell()
+    copied = 0
+    copy_funcs = [
+        lambda off, count: os.copy_file_range(in_fd, out_fd, count, off),
+        lambda off, count: os.sendfile(out_fd, in_fd, off, count),
+    ]
+    for copy_func in copy_funcs:
+        try:
+            while copied < size:
+                n = copy_func(in_off + copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError) as err:
+            log.debug("falling back from zero copy: %s", err)
+            continue
+        break
+
+    # the kernel moved the output fd's offset, resync the python file object
+    try:
+        out_f.seek(0, os.SEEK_CUR)
+    except OSError:
+        pass
+
+    in_f.seek(in_off + copied)
+    if copied < size:
+        for chunk in iter_file_chunks(in_f):
+            chunk = chunk[:size - copied]
+            out_f.write(chunk)
+            copied += len(chunk)
+            if copied >= size:
+                break
+    in_f.seek(in_off + copied)
+    return copied
+
+
+def rebatch(chunks, size):
+    """
+    Regroup an iterable of chunks into bytes objects of exactly size bytes,
+    except for the last one
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+    if pending:
+        yield bytes(pending)
+
+
+def parallel_map(func, items, jobs):
+    """
+    Ordered map of func over items on a process pool. Only a small window of
+    items is in flight at once so memory use does not grow with the input
+    """
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        yield from map(func, items)
+        return
+
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _deflate_block(block):
+    # raw deflate ending on a byte boundary with a sync flush, so that
+    # independently compressed blocks can be concatenated into one stream
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _bzip2_block(block):
+    """
+    Compress block into a bzip2 stream holding exactly one bzip2 block and
+    return (block bits, number of bits, block crc), with the bits between
+    the stream header and the end of stream marker left aligned in bytes
+    """
+    stream = bz2.compress(block, 9)
+    value = int.from_bytes(stream, "big")
+    total = len(stream) * 8
+    block_crc = (value >> (total - 80 - 32)) & 0xffffffff
+    # the stream ends with the end of stream magic, the combined crc and
+    # 0-7 bits of padding. With a single block the combined crc is the
+    # block crc
+    for pad in range(8):
+        end = total - pad - 80
+        if ((value >> (pad + 32)) & BZ2_MASK48 == BZ2_EOS_MAGIC and
+                (value >> pad) & 0xffffffff == block_crc):
+            break
+    else:
+        raise ValueError("bzip2 stream holds more than one block")
+    nbits = end - 32
+    nbytes = (nbits + 7) // 8
+    bits = (value >> (total - end)) & ((1 << nbits) - 1)
+    return (bits << (nbytes * 8 - nbits)).to_bytes(nbytes, "big"), nbits, \
+        block_crc
+
+
+def compress_gzip(chunks, jobs=None):
+    """
+    pigz style gzip. Blocks are deflated independently on a process pool and
+    stitched together into a single gzip member, with the crc of the
+    uncompressed data calculated in this process as the blocks go by
+    """
+    # magic, deflate, no flags, no mtime, no extra flags, unix
+    yield b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+    data_crc = 0
+    data_size = 0
+
+    def blocks():
+        nonlocal data_crc, data_size
+        for block in rebatch(chunks, COMPRESS_BLOCK_SIZE):
+            data_crc = zlib.crc32(block, data_crc)
+            data_size += len(block)
+            yield block
+
+    yield from parallel_map(_deflate_block, blocks(), jobs)
+    # empty final block to terminate the deflate stream
+    yield zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+    yield struct.pack("<II", data_crc, data_size & 0xffffffff)
+
+
+def compress_bzip2(chunks, jobs=None):
+    """
+    lbzip2 style bzip2. Blocks small enough to always fit in a single bzip2
+    block are compressed on a process pool and their bits are spliced into
+    one stream, since u-boot and the kernel stop decompressing at the first
+    end of stream marker
+    """
+    yield b"BZh9"
+    combined_crc = 0
+    # bits that didn't fill a byte yet and how many there are
+    carry = 0
+    carry_bits = 0
+    for data, nbits, block_crc in parallel_map(
+            _bzip2_block, rebatch(chunks, BZ2_BLOCK_SIZE), jobs):
+        combined_crc = (((combined_crc << 1) | (combined_crc >> 31)) &
+                        0xffffffff) ^ block_crc
+        if carry_bits == 0 and nbits % 8 == 0:
+            yield data
+            continue
+        bits = int.from_bytes(data, "big") >> (len(data) * 8 - nbits)
+        value = (carry << nbits) | bits
+        total = carry_bits + nbits
+        carry_bits = total % 8
+        carry = value & ((1 << carry_bits) - 1)
+        yield (value >> carry_bits).to_bytes(total // 8, "big")
+    tail_bits = carry_bits + 80
+    value = (((carry << 48) | BZ2_EOS_MAGIC) << 32) | combined_crc
+    pad = -tail_bits % 8
+    yield (value << pad).to_bytes((tail_bits + pad) // 8, "big")
+
+
+def compress_with(compressor, chunks):
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def compression_unsupported(compression_type):
+    """
+    Why compression_type can't be used here, or None if it can. Checked
+    before any output is opened so a missing module doesn't leave a
+    truncated image behind
+    """
+    if compression_type in (IHCompression.IH_COMP_NONE,
+                            IHCompression.IH_COMP_GZIP,
+                            IHCompression.IH_COMP_BZIP2,
+                            IHCompression.IH_COMP_LZMA):
+        return None
+    if compression_type == IHCompression.IH_COMP_LZ4:
+        return None if lz4 is not None else \
+            "lz4 compression requires the lz4 module"
+    if compression_type == IHCompression.IH_COMP_ZSTD:
+        return None if zstandard is not None else \
+            "zstd compression requires the zstandard module"
+    name = enum_name(IHCompression, compression_type)
+    return "%s compression is not yet implemented" % \
+        name.replace("IH_COMP_", "").lower()
+
+
+def compress_chunks(chunks, compression_type, jobs=None):
+    """
+    Compress an iterable of chunks, yielding the compressed data as it
+    becomes available
+    """
     if compression_type == IHCompression.IH_COMP_NONE:
-        return data
+        return iter(chunks)
+    return script_stats.timed_iter(
+        "compress", _compress_chunks(chunks, compression_type, jobs))
+
+
+def _compress_chunks(chunks, compression_type, jobs=None):
+    reason = compression_unsupported(compression_type)
+    if reason is not None:
+        raise NotImplementedError(reason)
+    if compression_type == IHCompression.IH_COMP_GZIP:
+        return compress_gzip(chunks, jobs)
+    if compression_type == IHCompression.IH_COMP_BZIP2:
+        return compress_bzip2(chunks, jobs)
+    if compression_type == IHCompression.IH_COMP_LZMA:
+        # u-boot expects the legacy .lzma container
+        return compress_with(lzma.LZMACompressor(format=lzma.FORMAT_ALONE),
+                             chunks)
+    if compression_type == IHCompression.IH_COMP_LZ4:
+        compressor = lz4.frame.LZ4FrameCompressor()
+        return _compress_lz4(compressor, chunks)
+    if compression_type == IHCompression.IH_COMP_ZSTD:
+        threads = jobs if jobs is not None else -1
+        compressor = zstandard.ZstdCompressor(threads=threads).compressobj()
+        return compress_with(compressor, chunks)
 
     raise NotImplementedError("Compression type is not yet implemented")
 
 
+def _compress_lz4(compressor, chunks):
+    yield compressor.begin()
+    yield from compress_with(compressor, chunks)
+
+
+def handle_compression(data, compression_type, jobs=None):
+    if compression_type == IHCompression.IH_COMP_NONE:
+        return data
+
+    return b"".join(compress_chunks([data], compression_type, jobs))
+
+
+def make_uimage_header(data_crc, data_size, entrypoint=0, load_address=0,
+                       compression=IHCompression.IH_COMP_NONE,
+                       operating_system=IHOS.IH_OS_LINUX,
+                       arch=IHArch.IH_ARCH_X86_64,
+                       image_type=IHImageType.IH_TYPE_KERNEL,
+                       timestamp=0,
+                       image_name=""
+                      ):
+    """
+    Build the UImageHeader for a payload that has already been checksummed.
+    The enum arguments can be members, ints or option strings
+    """
+    if isinstance(image_name, str):
+        image_name = image_name.encode()
+    header = UImageHeader(ih_magic=IH_MAGIC,
+                          ih_hcrc=0,
+                          ih_time=timestamp,
+                          ih_size=data_size,
+                          ih_load=load_address,
+                          ih_ep=entrypoint,
+                          ih_dcrc=data_crc,
+                          ih_os=enum_value(IHOS, operating_system),
+                          ih_arch=enum_value(IHArch, arch),
+                          ih_type=enum_value(IHImageType, image_type),
+                          ih_comp=enum_value(IHCompression, compression),
+                          ih_name=image_name[:IH_NMLEN])
+    raw_header = encode_uimage_header(header)
+    header = header._replace(
+        ih_hcrc=_HCRC_STRUCT.unpack_from(raw_header, _HCRC_OFFSET)[0])
+
+    if log.isEnabledFor(logging.DEBUG):
+        for name, value in header._asdict().items():
+            if name == "ih_name":
+                log.debug("%s %s", name, str(value))
+            else:
+                log.debug("%s %#x", name, value)
+    return header
+
+
 def gen_uimage_header(data, entrypoint=0, load_address=0,
                       compression=IHCompression.IH_COMP_NONE,
                       operating_system=IHOS.IH_OS_LINUX,
                       arch=IHArch.IH_ARCH_X86_64,
                       image_type=IHImageType.IH_TYPE_KERNEL,
                       timestamp=0,
-                      image_name=""
+                      image_name="",
+                      jobs=None
                      ):
-    header = LegacyUImageHeader()
-    header.ih_magic = IH_MAGIC
-    header.ih_ep = entrypoint
-    header.ih_load = load_address
-
-    header.ih_comp = compress_opts.get_value_from_string(compression)
-    compressed_data = handle_compression(data, header.ih_comp)
-
-    header.ih_dcrc = zlib.crc32(compressed_data)
-    header.ih_size = len(compressed_data)
-    header.ih_os = os_opts.get_value_from_string(operating_system)
-    header.ih_arch = arch_opts.get_value_from_string(arch)
-    header.ih_type = image_type_opts.get_value_from_string(image_type)
-    header.ih_time = timestamp
-    if isinstance(image_name, str):
-        encoded_name = image_name.encode()
+    compressed_data = handle_compression(
+        data, enum_value(IHCompression, compression), jobs)
+    header = make_uimage_header(zlib.crc32(compressed_data),
+                                len(compressed_data),
+                                entrypoint=entrypoint,
+                                load_address=load_address,
+                                compression=compression,
+                                operating_system=operating_system,
+                                arch=arch,
+                                image_type=image_type,
+                                timestamp=timestamp,
+                                image_name=image_name)
+    return encode_uimage_header(header) + compressed_data
+
+
+def write_uimage_stream(chunks, out_f, **header_kwargs):
+    """
+    Write an iterable of payload chunks to out_f as a uImage. A placeholder
+    header is written first and filled in once the size and crc of the
+    payload are known, so out_f has to be seekable
+    """
+    header_off = out_f.tell()
+    out_f.write(bytes(UIMAGE_HEADER_SIZE))
+    data_crc = 0
+    data_size = 0
+    crc_phase = script_stats.phase("crc")
+    write_phase = script_stats.phase("write")
+    for chunk in chunks:
+        with crc_phase:
+            data_crc = zlib.crc32(chunk, data_crc)
+        with write_phase:
+            out_f.write(chunk)
+        data_size += len(chunk)
+    crc_phase.add(data_size)
+    write_phase.add(data_size)
+    end_off = out_f.tell()
+
+    header = make_uimage_header(data_crc, data_size, **header_kwargs)
+    out_f.seek(header_off)
+    out_f.write(encode_uimage_header(header))
+    out_f.seek(end_off)
+    return header
+
+
+def write_uimage(in_f, out_f, jobs=None, **header_kwargs):
+    """
+    Wrap the contents of in_f into a uImage written to out_f without reading
+    the whole payload into memory. For uncompressed regular files the crc is
+    calculated in a first pass so the header can be written up front and the
+    payload copied by the kernel, anything else (compressed data or a pipe)
+    goes through write_uimage_stream
+    """
+    compression = enum_value(IHCompression, header_kwargs.get(
+        "compression", IHCompression.IH_COMP_NONE))
+    try:
+        start = in_f.tell()
+        seekable = in_f.seekable()
+    except OSError:
+        seekable = False
+
+    if not seekable or compression != IHCompression.IH_COMP_NONE:
+        chunks = compress_chunks(iter_file_chunks(in_f), compression, jobs)
+        return write_uimage_stream(chunks, out_f, **header_kwargs)
+
+    data_crc, data_size = crc_chunks(iter_file_chunks(in_f))
+    in_f.seek(start)
+    header = make_uimage_header(data_crc, data_size, **header_kwargs)
+    out_f.write(encode_uimage_header(header))
+    copy_payload(in_f, out_f, data_size)
+    return header
+
+
+def iter_multi_image_chunks(paths):
+    """
+    Yield the data section of a Multi-File image made from the files at
+    paths: the table of image sizes and its terminating 0, followed by each
+    file padded out to a multiple of 4 bytes (except for the last one).
+    Files are streamed one after the other, never concatenated in memory
+    """
+    sizes = [os.stat(path).st_size for path in paths]
+    yield struct.pack(">%dI" % (len(sizes) + 1), *sizes, 0)
+    for i, (path, size) in enumerate(zip(paths, sizes)):
+        with open(path, "rb") as f:
+            yield from iter_file_chunks(f)
+        padding = ROUND(size, 4) - size
+        if padding and i != len(paths) - 1:
+            yield bytes(padding)
+
+
+def write_multi_uimage(paths, out_f, jobs=None, **header_kwargs):
+    """
+    Write an IH_TYPE_MULTI uImage containing each of the files at paths to
+    out_f. The data crc is calculated in the same pass that writes the
+    images out, so out_f has to be seekable
+    """
+    header_kwargs["image_type"] = IHImageType.IH_TYPE_MULTI
+    compression = enum_value(IHCompression, header_kwargs.get(
+        "compression", IHCompression.IH_COMP_NONE))
+    chunks = compress_chunks(iter_multi_image_chunks(paths), compression, jobs)
+    return write_uimage_stream(chunks, out_f, **header_kwargs)
+
+
+UImageHit = namedtuple("UImageHit", ["path", "offset", "header", "data_ok"])
+
+
+def scan_uimages(path, check_data=False):
+    """
+    Find every uImage header in the file at path. Candidate offsets are found
+    by searching a memory map of the file for IH_MAGIC, and only headers with
+    a valid ih_hcrc are yielded. If check_data is set, ih_dcrc is also
+    checked and reported in data_ok, otherwise data_ok is None
+    """
+    header_size = UIMAGE_HEADER_SIZE
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < header_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            off = mm.find(IH_MAGIC_BYTES)
+            while off != -1 and off + header_size <= size:
+                raw_header = mm[off:off + header_size]
+                header = decode_uimage_header(raw_header)
+                if uimage_header_crc(raw_header) != header.ih_hcrc:
+                    log.debug("%s: bad header crc at %#x", path, off)
+                    off = mm.find(IH_MAGIC_BYTES, off + 1)
+                    continue
+
+                data_ok = None
+                if check_data:
+                    data_start = off + header_size
+                    data_end = data_start + header.ih_size
+                    data_ok = data_end <= size
+                    if data_ok:
+                        with memoryview(mm) as view:
+                            data_crc = zlib.crc32(view[data_start:data_end])
+                        data_ok = data_crc == header.ih_dcrc
+                yield UImageHit(path, off, header, data_ok)
+                off = mm.find(IH_MAGIC_BYTES, off + 1)
+
+
+def extract_uimage(hit, out_dir):
+    """
+    Write the payload of a scanned uImage out to out_dir, returning the path
+    it was written to
+    """
+    name = hit.header.ih_name.rstrip(b"\x00").decode(errors="replace")
+    name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+    out_path = os.path.join(out_dir, "%s_%#x%s.bin" % (
+        os.path.basename(hit.path), hit.offset, "_" + name if name else ""))
+    with open(hit.path, "rb") as in_f, open(out_path, "wb") as out_f:
+        in_f.seek(hit.offset + UIMAGE_HEADER_SIZE)
+        copy_payload(in_f, out_f, hit.header.ih_size)
+    return out_path
+
+
+def _scan_file(path, check_data=False, extract_dir=None):
+    hits = []
+    try:
+        for hit in scan_uimages(path, check_data):
+            if extract_dir is not None and hit.data_ok is not False:
+                extract_uimage(hit, extract_dir)
+            hits.append(hit)
+    except (OSError, ValueError) as err:
+        log.warning("%s: %s", path, err)
+    return hits
+
+
+def iter_scan_files(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, _, filenames in os.walk(path):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                try:
+                    if stat.S_ISREG(os.lstat(filepath).st_mode):
+                        yield filepath
+                except OSError:
+                    pass
+
+
+def scan_paths(paths, check_data=False, extract_dir=None, jobs=None):
+    """
+    Scan every file in paths (walking directories) for uImages on a process
+    pool, yielding hits a file at a time
+    """
+    if extract_dir is not None:
+        os.makedirs(extract_dir, exist_ok=True)
+    scan_func = partial(_scan_file, check_data=check_data,
+                        extract_dir=extract_dir)
+    for hits in parallel_map(scan_func, iter_scan_files(paths), jobs):
+        yield from hits
+
+
+def enum_name(enum_class, value):
+    try:
+        return enum_class(value).name
+    except ValueError:
+        return str(value)
+
+
+def format_hit(hit):
+    header = hit.header
+    if hit.data_ok is None:
+        data_status = ""
     else:
-        encoded_name = image_name
-    for i, s in enumerate(encoded_name[:sizeof(header.ih_name)]):
-        header.ih_name[i] = s
+        data_status = " dcrc=%s" % ("ok" if hit.data_ok else "bad")
+    return "%s:%#x %s size=%#x load=%#x ep=%#x %s %s %s %s%s" % (
+        hit.path, hit.offset,
+        header.ih_name.rstrip(b"\x00").decode(errors="replace"),
+        header.ih_size, header.ih_load, header.ih_ep,
+        enum_name(IHOS, header.ih_os),
+        enum_name(IHArch, header.ih_arch),
+        enum_name(IHImageType, header.ih_type),
+        enum_name(IHCompression, header.ih_comp),
+        data_status)
+
+
+MANIFEST_DEFAULTS = {
+    "load_address": 0,
+    "entrypoint": 0,
+    "operating_system": "LINUX",
+    "architecture": "X86_64",
+    "image_type": "KERNEL",
+    "compression": "NONE",
+    "timestamp": 0,
+    "image_name": "",
+}
+# the short names jobs can use for the parameters in MANIFEST_DEFAULTS
+MANIFEST_ALIASES = {
+    "load": "load_address",
+    "entry": "entrypoint",
+    "os": "operating_system",
+    "arch": "architecture",
+    "type": "image_type",
+    "name": "image_name",
+}
+MANIFEST_ENUMS = {
+    "operating_system": IHOS,
+    "architecture": IHArch,
+    "image_type": IHImageType,
+    "compression": IHCompression,
+}
+
+
+def manifest_job_params(job):
+    """
+    Normalize the wrapping parameters of a manifest job so that equivalent
+    jobs (e.g. "x86_64" vs "X86_64", "0x1000" vs 4096, "arch" vs
+    "architecture") compare equal. Raises ValueError for unknown keys and
+    bad values rather than quietly building with the defaults
+    """
+    params = dict(MANIFEST_DEFAULTS)
+    given = set()
+    for key, value in job.items():
+        if key in ("input", "output"):
+            continue
+        name = MANIFEST_ALIASES.get(key, key)
+        if name not in MANIFEST_DEFAULTS:
+            raise ValueError("unknown key %r" % key)
+        if name in given:
+            raise ValueError("%s is given more than once" % name)
+        given.add(name)
+        params[name] = value
+    for key in ["load_address", "entrypoint", "timestamp"]:
+        try:
+            if isinstance(params[key], str):
+                params[key] = int(params[key], 0)
+            elif not isinstance(params[key], int):
+                raise ValueError
+        except ValueError:
+            raise ValueError("bad %s %r" % (key, params[key]))
+    for key, enum_class in MANIFEST_ENUMS.items():
+        try:
+            params[key] = int(enum_value(enum_class, params[key]))
+        except (KeyError, ValueError, TypeError):
+            raise ValueError("bad %s %r" % (key, params[key]))
+    if not isinstance(params["image_name"], str):
+        raise ValueError("bad image_name %r" % (params["image_name"],))
+    return params
+
+
+def check_manifest_job(job):
+    """
+    Raise ValueError if job is missing its input or output or has
+    parameters that can't be used
+    """
+    if not isinstance(job, dict):
+        raise ValueError("not an object")
+    inputs = job.get("input")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not inputs or not isinstance(inputs, list) or \
+            not all(isinstance(i, str) for i in inputs):
+        raise ValueError("input must be a path or a list of paths")
+    if not isinstance(job.get("output"), str):
+        raise ValueError("output must be a path")
+    params = manifest_job_params(job)
+    reason = compression_unsupported(params["compression"])
+    if reason is not None:
+        raise ValueError(reason)
+
+
+def hash_files(paths):
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter_file_chunks(f):
+                h.update(chunk)
+        # keep ["ab", "c"] and ["a", "bc"] distinct
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def run_manifest_job(job, cache_entry=None):
+    """
+    Wrap a single manifest job unless cache_entry shows that the output
+    already exists and was built from identical inputs and parameters.
+    Returns (output path, cache entry, whether the image was rebuilt)
+    """
+    inputs = job["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    output = job["output"]
+    params = manifest_job_params(job)
+    input_hash = hash_files(inputs)
+
+    if cache_entry is not None and cache_entry.get("input_hash") == input_hash \
+            and cache_entry.get("params") == params:
+        try:
+            st = os.stat(output)
+            if st.st_size == cache_entry["output_size"] and \
+                    st.st_mtime_ns == cache_entry["output_mtime_ns"]:
+                return output, cache_entry, False
+        except OSError:
+            pass
+
+    header_kwargs = dict(entrypoint=params["entrypoint"],
+                         load_address=params["load_address"],
+                         compression=IHCompression(params["compression"]),
+                         operating_system=IHOS(params["operating_system"]),
+                         arch=IHArch(params["architecture"]),
+                         image_type=IHImageType(params["image_type"]),
+                         timestamp=params["timestamp"],
+                         image_name=params["image_name"])
+    # written next to the output and renamed over it once it is complete,
+    # so a failed job never leaves a truncated image behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output),
+                                    prefix=".%s." % os.path.basename(output))
+    try:
+        # jobs are already spread over a process pool, so compress in-process
+        with os.fdopen(fd, "wb") as out_f:
+            if len(inputs) > 1 or \
+                    params["image_type"] == IHImageType.IH_TYPE_MULTI:
+                write_multi_uimage(inputs, out_f, jobs=1, **header_kwargs)
+            else:
+                with open(inputs[0], "rb") as in_f:
+                    write_uimage(in_f, out_f, jobs=1, **header_kwargs)
+        os.chmod(tmp_path, 0o666 & ~_umask())
+        os.replace(tmp_path, output)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    st = os.stat(output)
+    cache_entry = {"input_hash": input_hash, "params": params,
+                   "output_size": st.st_size,
+                   "output_mtime_ns": st.st_mtime_ns}
+    return output, cache_entry, True
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _run_manifest_job(job_and_entry):
+    job, cache_entry = job_and_entry
+    try:
+        return run_manifest_job(job, cache_entry)
+    except (OSError, KeyError, ValueError, NotImplementedError) as err:
+        log.error("%s: %s", job.get("output"), err)
+        return job.get("output"), None, False
+
 
-    header.ih_hcrc = zlib.crc32(bytes(header))
+def run_manifest(manifest_path, cache_path=None, jobs=None):
+    """
+    Run every job in a json manifest (a list of objects with "input",
+    "output" and any of the keys in MANIFEST_DEFAULTS or MANIFEST_ALIASES)
+    on a process pool. Relative paths are relative to the manifest. Jobs
+    whose input contents and parameters match the cache from the previous
+    run are skipped. Every job is checked before any are run, raising
+    ValueError naming the bad jobs by index. Returns the number of images
+    rebuilt, the number of jobs and the number of jobs that failed
+    """
+    manifest_path = os.path.abspath(manifest_path)
+    manifest_dir = os.path.dirname(manifest_path)
+    if cache_path is None:
+        cache_path = manifest_path + ".cache.json"
+
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise ValueError("%s: the manifest must be a list of jobs" %
+                         manifest_path)
+    problems = []
+    for i, job in enumerate(manifest):
+        try:
+            check_manifest_job(job)
+        except ValueError as err:
+            problems.append("job %d: %s" % (i, err))
+    if problems:
+        raise ValueError("%s: %s" % (manifest_path, "; ".join(problems)))
 
-    log.debug("ih_magic %#x", header.ih_magic)
-    log.debug("ih_hcrc %#x", header.ih_hcrc)
-    log.debug("ih_time %#x", header.ih_time)
-    log.debug("ih_size %#x", header.ih_size)
-    log.debug("ih_load %#x", header.ih_load)
-    log.debug("ih_ep %#x", header.ih_ep)
-    log.debug("ih_dcrc %#x", header.ih_dcrc)
-    log.debug("ih_os %#x", header.ih_os)
-    log.debug("ih_arch %#x", header.ih_arch)
-    log.debug("ih_type %#x", header.ih_type)
-    log.debug("ih_comp %#x", header.ih_comp)
-    log.debug("ih_name %s", str(bytes(header.ih_name)))
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    work = []
+    for job in manifest:
+        job = dict(job)
+        if isinstance(job["input"], str):
+            job["input"] = [job["input"]]
+        job["input"] = [os.path.join(manifest_dir, os.path.expanduser(i))
+                        for i in job["input"]]
+        job["output"] = os.path.join(manifest_dir,
+                                     os.path.expanduser(job["output"]))
+        work.append((job, cache.get(job["output"])))
+
+    rebuilt = 0
+    failed = 0
+    for output, cache_entry, was_rebuilt in parallel_map(_run_manifest_job,
+                                                         work, jobs):
+        if cache_entry is None:
+            cache.pop(output, None)
+            failed += 1
+            continue
+        cache[output] = cache_entry
+        if was_rebuilt:
+            rebuilt += 1
+            log.info("wrapped %s", output)
+        else:
+            log.info("up to date %s", output)
 
-    return bytes(header) + compressed_data
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)))
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+    return rebuilt, len(work), failed
 
 
 if __name__ == "__main__":
-    compress_opts = IntEnumArgOptions(IHCompression, "IH_COMP_")
-    image_type_opts = IntEnumArgOptions(IHImageType, "IH_TYPE_", ["INVALID"])
-    arch_opts = IntEnumArgOptions(IHArch, "IH_ARCH_", ["INVALID"])
-    os_opts = IntEnumArgOptions(IHOS, "IH_OS_", ["INVALID"])
+    compress_opts = get_arg_options(IHCompression)
+    image_type_opts = get_arg_options(IHImageType)
+    arch_opts = get_arg_options(IHArch)
+    os_opts = get_arg_options(IHOS)
 
     parser = argparse.ArgumentParser(formatter_class=CustomFormatter)
-    parser.add_argument("filepath", help="Path to file to wrap",
+    parser.add_argument("filepath", nargs="*",
+                        help="Path to file to wrap, - for stdin. Passing "
+                             "more than one file (or an image type of MULTI) "
+                             "creates a Multi-File image",
                         type=os.path.expanduser)
     parser.add_argument("-l", "--load-address",
                         help="address to load image at",
@@ -423,32 +1269,109 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--compression",
                         choices=compress_opts.option_strings,
                         default="NONE")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of processes to compress with. "
+                             "Defaults to the number of cpus")
     parser.add_argument("-t", "--timestamp", help="timestamp", type=int, default=0)
     parser.add_argument("-n", "--image-name", default="")
     parser.add_argument("-d", "--dry-run", action="store_true", default=False)
     parser.add_argument("--debug", action="store_true", default=False)
     parser.add_argument("-o", "--output", help="path to output to")
+    parser.add_argument("--scan", action="store_true", default=False,
+                        help="instead of wrapping, scan the given files "
+                             "(and directories, recursively) for uImages")
+    parser.add_argument("--verify-data", action="store_true", default=False,
+                        help="check the data crc of scanned images")
+    parser.add_argument("-x", "--extract-dir",
+                        help="extract the payloads of scanned images into "
+                             "this directory", type=os.path.expanduser)
+    parser.add_argument("-m", "--manifest", type=os.path.expanduser,
+                        help="json list of wrap jobs to run in parallel. "
+                             "Each job has an input and output path and any "
+                             "of the long option names above (with "
+                             "underscores), or load, entry, os, arch, type "
+                             "and name, as parameters. Exits non-zero if "
+                             "any job fails")
+    parser.add_argument("--cache", type=os.path.expanduser,
+                        help="cache file used to skip unchanged manifest "
+                             "jobs. Defaults to <manifest>.cache.json")
+    script_stats.add_arguments(parser)
     args = parser.parse_args()
+    if not args.filepath and not args.manifest:
+        parser.error("a filepath or --manifest is required")
+    if not (args.manifest or args.scan):
+        if "-" in args.filepath and (
+                len(args.filepath) > 1 or
+                image_type_opts.get_value_from_string(args.image_type) ==
+                IHImageType.IH_TYPE_MULTI):
+            parser.error("- (stdin) can't be used in a Multi-File image, "
+                         "the size of every file is needed up front")
+        reason = compression_unsupported(
+            compress_opts.get_value_from_string(args.compression))
+        if reason is not None:
+            parser.error(reason)
 
     if args.debug:
         log.setLevel(logging.DEBUG)
         log.debug(args)
 
-    with open(args.filepath, "rb") as f:
-        contents = f.read()
+    with script_stats.from_args(args, "uimage_wrap"):
+        header_kwargs = dict(entrypoint=args.entrypoint,
+                             load_address=args.load_address,
+                             compression=args.compression,
+                             operating_system=args.operating_system,
+                             arch=args.architecture,
+                             image_type=args.image_type,
+                             timestamp=args.timestamp,
+                             image_name=args.image_name)
 
+        if args.manifest:
+            try:
+                with script_stats.phase("manifest"):
+                    rebuilt, total, failed = run_manifest(
+                        args.manifest, args.cache, args.jobs)
+            except (OSError, ValueError) as err:
+                log.error("%s", err)
+                sys.exit(1)
+            print("wrapped %d of %d images%s" %
+                  (rebuilt, total, ", %d failed" % failed if failed else ""))
+            sys.exit(1 if failed else 0)
 
-    uimage_data = gen_uimage_header(contents,
-                                    entrypoint=args.entrypoint,
-                                    load_address=args.load_address,
-                                    compression=args.compression,
-                                    operating_system=args.operating_system,
-                                    arch=args.architecture,
-                                    image_type=args.image_type,
-                                    timestamp=args.timestamp,
-                                    image_name=args.image_name)
+        if args.scan:
+            hits = scan_paths(args.filepath, check_data=args.verify_data,
+                              extract_dir=args.extract_dir, jobs=args.jobs)
+            for hit in script_stats.timed_iter("scan", hits, measure=None):
+                print(format_hit(hit))
+            sys.exit(0)
 
-    if args.output and not args.dry_run:
-        with open(args.output, "wb") as f:
-            f.write(uimage_data)
+        multi = len(args.filepath) > 1 or \
+            image_type_opts.get_value_from_string(args.image_type) == IHImageType.IH_TYPE_MULTI
+        compression = compress_opts.get_value_from_string(args.compression)
 
+        if multi:
+            if args.output and not args.dry_run:
+                with open(args.output, "wb") as f:
+                    write_multi_uimage(args.filepath, f, jobs=args.jobs,
+                                       **header_kwargs)
+            else:
+                chunks = compress_chunks(iter_multi_image_chunks(args.filepath),
+                                         compression, args.jobs)
+                data_crc, data_size = crc_chunks(chunks)
+                header_kwargs["image_type"] = IHImageType.IH_TYPE_MULTI
+                make_uimage_header(data_crc, data_size, **header_kwargs)
+            sys.exit(0)
+
+        if args.filepath[0] == "-":
+            in_f = open(sys.stdin.fileno(), "rb", closefd=False)
+        else:
+            in_f = open(args.filepath[0], "rb")
+
+        with in_f:
+            if args.output and not args.dry_run:
+                with open(args.output, "wb") as f:
+                    write_uimage(in_f, f, jobs=args.jobs, **header_kwargs)
+            else:
+                chunks = compress_chunks(iter_file_chunks(in_f), compression,
+                                         args.jobs)
+                data_crc, data_size = crc_chunks(chunks)
+                make_uimage_header(data_crc, data_size, **header_kwargs)